@@ -1,11 +1,43 @@
 #!/usr/bin/env python3
 
 
-from pprint import pprint as pp
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
+import asyncio
+import base64
+import bisect
+import functools
+import heapq
+import io
+import itertools
+import json
 import logging
+import mmap
+import multiprocessing
+import multiprocessing.reduction
+import os
+import pickle
 import re
 import sqlite3
+import struct
+import sys
+import threading
+import time
+import types
+import urllib.parse
+import zlib
+
+
+log = logging.getLogger('aboutdb')
+TRACE = False
+
+
+def trace(enabled=True):
+    global TRACE
+    TRACE = enabled
 
 
 class colors:
@@ -45,6 +77,120 @@ class colors:
         lightgrey = '\033[47m'
 
 
+NONE, FALSE, TRUE, INT, FLOAT, STR, BYTES, LIST, DICT = range(9)
+_float = struct.Struct('>d')
+
+
+def _varint(n, out):
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(data, offset):
+    result = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, offset
+        shift += 7
+
+
+_key_types = (type(None), bool, int, float, str, bytes)
+
+
+def _encode(value, out):
+    kind = type(value)
+    if value is None:
+        out.append(NONE)
+    elif kind is bool:
+        out.append(TRUE if value else FALSE)
+    elif kind is int:
+        out.append(INT)
+        _varint(value << 1 if value >= 0 else (-value << 1) - 1, out)
+    elif kind is float:
+        out.append(FLOAT)
+        out += _float.pack(value)
+    elif kind is str:
+        data = value.encode('utf-8')
+        out.append(STR)
+        _varint(len(data), out)
+        out += data
+    elif kind in (bytes, bytearray, memoryview):
+        out.append(BYTES)
+        _varint(len(value), out)
+        out += value
+    elif kind in (list, tuple):
+        out.append(LIST)
+        _varint(len(value), out)
+        for element in value:
+            _encode(element, out)
+    elif kind is dict:
+        out.append(DICT)
+        _varint(len(value), out)
+        for key, element in value.items():
+            if type(key) not in _key_types:
+                raise TypeError("Cannot encode dict key of type %s" % type(key).__name__)
+            _encode(key, out)
+            _encode(element, out)
+    else:
+        raise TypeError("Cannot encode value of type %s" % kind.__name__)
+
+
+def _decode(data, offset):
+    tag = data[offset]
+    offset += 1
+    if tag == NONE:
+        return None, offset
+    elif tag == FALSE:
+        return False, offset
+    elif tag == TRUE:
+        return True, offset
+    elif tag == INT:
+        n, offset = _read_varint(data, offset)
+        return (n >> 1) if not n & 1 else -((n + 1) >> 1), offset
+    elif tag == FLOAT:
+        return _float.unpack_from(data, offset)[0], offset + _float.size
+    elif tag == STR:
+        size, offset = _read_varint(data, offset)
+        return str(data[offset:offset+size], 'utf-8'), offset + size
+    elif tag == BYTES:
+        size, offset = _read_varint(data, offset)
+        return bytes(data[offset:offset+size]), offset + size
+    elif tag == LIST:
+        count, offset = _read_varint(data, offset)
+        result = []
+        for _ in range(count):
+            value, offset = _decode(data, offset)
+            result.append(value)
+        return result, offset
+    elif tag == DICT:
+        count, offset = _read_varint(data, offset)
+        result = {}
+        for _ in range(count):
+            key, offset = _decode(data, offset)
+            result[key], offset = _decode(data, offset)
+        return result, offset
+    raise ValueError("Unknown value tag %d" % tag)
+
+
+def encode(value):
+    out = bytearray()
+    _encode(value, out)
+    return bytes(out)
+
+
+def encode_many(values):
+    return [encode(value) for value in values]
+
+
+def decode(data):
+    return _decode(memoryview(data), 0)[0]
+
+
 class Item:
     def __init__(self, identity, field, value):
         self.identity = identity
@@ -52,19 +198,13 @@ class Item:
         self.value = value
 
     def as_bytes(self):
-        result = b''
-        if type(self.value) is str:
-            result = self.value.encode('utf-8')
-        elif type(self.value) is int:
-            result = self.value.to_bytes(4, "big")
-        logging.debug("Converted '%s' to %s", self.value, result)
+        result = encode(self.value)
+        if TRACE:
+            log.debug("Converted %r to %r", self.value, result)
         return result
 
     def from_bytes(type, data):
-        if type is str:
-            return data.decode('utf-8')
-        elif type is int:
-            return int.from_bytes(data, "big")
+        return decode(data)
 
     def __repr__(self):
         return "<%s::%s = '%s'>" % (self.identity, self.field, self.value)
@@ -76,11 +216,16 @@ class List:
         self.field = field
         self.value = value
 
+    def as_bytes(self):
+        return encode(self.value)
+
     def __repr__(self):
         return "<%s::%s = %s>" % (self.identity, self.field, self.value)
 
 
 class Link:
+    __slots__ = ('identity',)
+
     def __init__(self, identity):
         self.identity = identity
 
@@ -88,7 +233,12 @@ class Link:
         return "<Link to '%s'>" % (self.identity)
 
 
+TYPES = (str, int, float, bool, type(None), bytes, list, dict)
+
+
 class Pointer:
+    __slots__ = ('chunk', 'type', 'position', 'size')
+
     def __init__(self, chunk: int, type: type, position: int, size: int):
         self.chunk = chunk
         self.type = type
@@ -102,25 +252,320 @@ class Pointer:
 class Register:
     def __init__(self):
         self._objects = {}
+        self._init_order()
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __contains__(self, identity):
+        return identity in self._objects
+
+    def _init_order(self):
+        self._order = []
+        self._sequence = array('Q')
+        self._sequence_of = {}
+        self._holes = 0
+        self._last_sequence = 0
+        self._members = {}
+
+    def _join(self, chunk, identity):
+        members = self._members.get(chunk)
+        if members is None:
+            members = self._members[chunk] = {}
+        members[identity] = members.get(identity, 0) + 1
+
+    def _leave(self, chunk, identity):
+        members = self._members[chunk]
+        if members[identity] > 1:
+            members[identity] -= 1
+        else:
+            del members[identity]
+
+    def members(self, chunk):
+        return list(self._members.get(chunk, ()))
+
+    def _appended(self, identity):
+        self._last_sequence += 1
+        sequence = self._last_sequence
+        self._order.append(identity)
+        self._sequence.append(sequence)
+        self._sequence_of[identity] = sequence
+
+    def _removed(self, identity):
+        sequence = self._sequence_of.pop(identity)
+        self._order[bisect.bisect_left(self._sequence, sequence)] = None
+        self._holes += 1
+        if self._holes > 1024 and self._holes * 2 > len(self._order):
+            live = [n for n, identity in enumerate(self._order) if identity is not None]
+            self._order = [self._order[n] for n in live]
+            self._sequence = array('Q', (self._sequence[n] for n in live))
+            self._holes = 0
+
+    def order(self):
+        return [(sequence, identity) for sequence, identity in zip(self._sequence, self._order)
+                if identity is not None]
+
+    def restore_order(self, last_sequence, order):
+        self._order = [identity for _, identity in order]
+        self._sequence = array('Q', (sequence for sequence, _ in order))
+        self._sequence_of = {identity: sequence for sequence, identity in order}
+        self._holes = 0
+        self._last_sequence = last_sequence
+
+    def scan(self, after=0, limit=1000):
+        n = bisect.bisect_right(self._sequence, after)
+        result = []
+        while n < len(self._order) and len(result) < limit:
+            if self._order[n] is not None:
+                result.append((self._sequence[n], self._order[n]))
+            n += 1
+        return result
 
     def set(self, object_id: str, field: str, pointer: Pointer):
         if object_id in self._objects.keys():
+            old = self._objects[object_id].get(field)
+            if isinstance(old, Pointer):
+                self._leave(old.chunk, object_id)
             self._objects[object_id][field] = pointer
         else:
             self._objects[object_id] = {field: pointer}
+            self._appended(object_id)
+        if isinstance(pointer, Pointer):
+            self._join(pointer.chunk, object_id)
 
     def unset(self, object_id: str, field: str):
-        del self._objects[object_id][field]
+        old = self._objects[object_id].pop(field)
+        if isinstance(old, Pointer):
+            self._leave(old.chunk, object_id)
 
     def get(self, identity):
         return self._objects[identity]
 
     def delete(self, identity):
-        del self._objects[identity]
+        for pointer in self._objects.pop(identity).values():
+            if isinstance(pointer, Pointer):
+                self._leave(pointer.chunk, identity)
+        self._removed(identity)
+
+    def pointer(self, identity, field):
+        return self._objects.get(identity, {}).get(field)
+
+    def identities(self):
+        return list(self._objects.keys())
+
+    def items(self):
+        for identity, fields in self._objects.items():
+            for field, pointer in fields.items():
+                yield identity, field, pointer
+
+    def column(self, field):
+        for identity, fields in self._objects.items():
+            pointer = fields.get(field)
+            if pointer is not None:
+                yield identity, pointer
+
+    def _order_usage(self):
+        return (sys.getsizeof(self._order) + sys.getsizeof(self._sequence) + sys.getsizeof(self._sequence_of)
+                + sum(sys.getsizeof(members) for members in self._members.values()))
+
+    def memory_usage(self):
+        total = sys.getsizeof(self._objects) + self._order_usage()
+        entries = 0
+        for fields in self._objects.values():
+            total += sys.getsizeof(fields)
+            for pointer in fields.values():
+                total += sys.getsizeof(pointer)
+                entries += 1
+        return {'bytes': total, 'entries': entries, 'per_entry': total / entries if entries else 0}
+
+
+class CompactRegister(Register):
+    link_chunk = 0xFFFFFFFF
+
+    def __init__(self):
+        self._objects = {}
+        self._field_names = []
+        self._field_ids = {}
+        self._chunk = array('I')
+        self._type = array('B')
+        self._position = array('Q')
+        self._size = array('I')
+        self._links = {}
+        self._free = []
+        self._init_order()
+
+    def _intern(self, field):
+        field_id = self._field_ids.get(field)
+        if field_id is None:
+            field_id = len(self._field_names)
+            self._field_names.append(sys.intern(field))
+            self._field_ids[field] = field_id
+        return field_id
+
+    def _alloc(self):
+        if self._free:
+            return self._free.pop()
+        self._chunk.append(0)
+        self._type.append(0)
+        self._position.append(0)
+        self._size.append(0)
+        return len(self._chunk) - 1
+
+    def _release(self, slot, identity):
+        if self._chunk[slot] != CompactRegister.link_chunk:
+            self._leave(self._chunk[slot], identity)
+        self._links.pop(slot, None)
+        self._free.append(slot)
+
+    def _write(self, slot, pointer):
+        if isinstance(pointer, Link):
+            self._chunk[slot] = CompactRegister.link_chunk
+            self._links[slot] = pointer.identity
+        else:
+            self._links.pop(slot, None)
+            self._chunk[slot] = pointer.chunk
+            self._type[slot] = TYPES.index(pointer.type)
+            self._position[slot] = pointer.position
+            self._size[slot] = pointer.size
+
+    def _read(self, slot):
+        if self._chunk[slot] == CompactRegister.link_chunk:
+            return Link(self._links[slot])
+        return Pointer(self._chunk[slot], TYPES[self._type[slot]], self._position[slot], self._size[slot])
+
+    def set(self, object_id: str, field: str, pointer: Pointer):
+        fields = self._objects.get(object_id)
+        if fields is None:
+            fields = self._objects[object_id] = {}
+            self._appended(object_id)
+        field_id = self._intern(field)
+        slot = fields.get(field_id)
+        if slot is None:
+            slot = fields[field_id] = self._alloc()
+        elif self._chunk[slot] != CompactRegister.link_chunk:
+            self._leave(self._chunk[slot], object_id)
+        self._write(slot, pointer)
+        if isinstance(pointer, Pointer):
+            self._join(pointer.chunk, object_id)
+
+    def unset(self, object_id: str, field: str):
+        fields = self._objects[object_id]
+        self._release(fields.pop(self._field_ids[field]), object_id)
+
+    def get(self, identity):
+        return {self._field_names[field_id]: self._read(slot)
+                for field_id, slot in self._objects[identity].items()}
+
+    def delete(self, identity):
+        for slot in self._objects.pop(identity).values():
+            self._release(slot, identity)
+        self._removed(identity)
+
+    def pointer(self, identity, field):
+        fields = self._objects.get(identity)
+        field_id = self._field_ids.get(field)
+        if fields is None or field_id not in fields:
+            return None
+        return self._read(fields[field_id])
+
+    def items(self):
+        for identity, fields in self._objects.items():
+            for field_id, slot in fields.items():
+                yield identity, self._field_names[field_id], self._read(slot)
+
+    def column(self, field):
+        field_id = self._field_ids.get(field)
+        if field_id is None:
+            return
+        for identity, fields in self._objects.items():
+            slot = fields.get(field_id)
+            if slot is not None:
+                yield identity, self._read(slot)
+
+    def memory_usage(self):
+        total = sys.getsizeof(self._objects) + sys.getsizeof(self._links) + sys.getsizeof(self._free)
+        total += sum(sys.getsizeof(column) for column in (self._chunk, self._type, self._position, self._size))
+        total += sys.getsizeof(self._field_names) + sys.getsizeof(self._field_ids) + self._order_usage()
+        entries = 0
+        for fields in self._objects.values():
+            total += sys.getsizeof(fields)
+            entries += len(fields)
+        return {'bytes': total, 'entries': entries, 'per_entry': total / entries if entries else 0}
+
+
+class Predicate:
+    operators = ('$eq', '$in', '$gt', '$gte', '$lt', '$lte')
+
+    def __init__(self, field, values=None, low=None, high=None, low_open=False, high_open=False):
+        self.field = field
+        self.values = values
+        self.low = low
+        self.high = high
+        self.low_open = low_open
+        self.high_open = high_open
+
+    @classmethod
+    def parse(cls, field, condition):
+        if type(condition) is not dict or not condition or not all(op in cls.operators for op in condition):
+            return cls(field, values=[condition])
+        predicate = cls(field)
+        for op, value in condition.items():
+            if op == '$eq':
+                predicate.values = [value]
+            elif op == '$in':
+                predicate.values = list(value)
+            elif op in ('$gt', '$gte'):
+                predicate.low, predicate.low_open = value, op == '$gt'
+            else:
+                predicate.high, predicate.high_open = value, op == '$lt'
+        return predicate
+
+    def coerce(self, field_type):
+        return Predicate(self.field,
+                         values=None if self.values is None else [field_type(v) for v in self.values],
+                         low=None if self.low is None else field_type(self.low),
+                         high=None if self.high is None else field_type(self.high),
+                         low_open=self.low_open, high_open=self.high_open)
+
+    def matches(self, value):
+        if type(value) is list:
+            return any(self.matches(element) for element in value)
+        try:
+            if self.values is not None and value not in self.values:
+                return False
+            if self.low is not None and (value <= self.low if self.low_open else value < self.low):
+                return False
+            if self.high is not None and (value >= self.high if self.high_open else value > self.high):
+                return False
+        except TypeError:
+            return False
+        return True
+
+    def sql(self):
+        where = []
+        args = []
+        if self.values is not None:
+            where.append("VALUE IN (%s)" % ', '.join('?' * len(self.values)))
+            args.extend(self.values)
+        if self.low is not None:
+            where.append("VALUE > ?" if self.low_open else "VALUE >= ?")
+            args.append(self.low)
+        if self.high is not None:
+            where.append("VALUE < ?" if self.high_open else "VALUE <= ?")
+            args.append(self.high)
+        return " AND ".join(where) or "1", args
+
+    def __repr__(self):
+        if self.values is not None:
+            return "<%s in %r>" % (self.field, self.values)
+        return "<%s in %s%r, %r%s>" % (self.field, '(' if self.low_open else '[', self.low,
+                                       self.high, ')' if self.high_open else ']')
 
 
 class Index:
-    clean = re.compile('[^A-Z_]')
+    clean = re.compile('[^A-Z0-9_]')
+    stats_sample = 32
+    kind = 'value'
 
     def __init__(self, schema, name, field=None, fn=None, field_type=str):
         self.schema = schema
@@ -128,13 +573,16 @@ class Index:
         self.field = field or name
         self.fn = fn
         self.field_type = field_type
+        self._stats = None
+        self._changes = 0
 
     @property
     def table_name(self):
         if self.schema is None:
-            return Index.clean.sub('', self.field.upper())
+            name = Index.clean.sub('', self.field.upper())
         else:
-            return Index.clean.sub('', '%s_%s' % (self.schema.upper(), self.name.upper()))
+            name = Index.clean.sub('', '%s_%s' % (self.schema.upper(), self.name.upper()))
+        return 'I_' + name if name[:1].isdigit() else name
 
     @property
     def value_type(self):
@@ -144,20 +592,26 @@ class Index:
         }[self.field_type]
 
     def build(self, conn: sqlite3.Connection):
+        self.existed = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                    (self.table_name,)).fetchone() is not None
         conn.execute("""
-            CREATE TABLE %s (
+            CREATE TABLE IF NOT EXISTS %s (
                 ID INTEGER PRIMARY KEY AUTOINCREMENT,
                 OBJECT_ID VARCHAR(64) NOT NULL,
                 VALUE %s
             )
             """ % (self.table_name, self.value_type))
+        conn.execute("CREATE INDEX IF NOT EXISTS %s_VALUE ON %s (VALUE, OBJECT_ID)"
+                     % (self.table_name, self.table_name))
+        conn.execute("CREATE INDEX IF NOT EXISTS %s_OBJECT_ID ON %s (OBJECT_ID)"
+                     % (self.table_name, self.table_name))
         conn.commit()
-        logging.debug("Initialized index %s", self.table_name)
+        log.debug("Initialized index %s", self.table_name)
         return self
 
     def handles(self, schema: str, item: Item):
         if self.schema is None:
-            return item.field == self.field and schema is None
+            return item.field == self.field
         else:
             return item.field == self.field and schema == self.schema
 
@@ -168,38 +622,467 @@ class Index:
         return self.schema == schema and field == self.field
 
     def run(self, conn: sqlite3.Connection, item: Item):
-        logging.debug('Index %s', repr(item))
+        if TRACE:
+            log.debug('Index %r', item)
+        self.run_many(conn, [item])
+        conn.commit()
 
+    def rows(self, item: Item):
         if type(item) is Item:
             values = [item.value]
         else:
             values = item.value
 
         if callable(self.fn):
-            for value in values:
-                conn.execute("""
-                    INSERT INTO %s (OBJECT_ID, VALUE)
-                    VALUES (?, ?)
-                    """ % self.table_name, (item.identity, self.field_type(self.fn(value))))
+            return [(item.identity, self.field_type(self.fn(value))) for value in values]
         else:
-            for value in values:
-                conn.execute("""
-                    INSERT INTO %s (OBJECT_ID, VALUE)
-                    VALUES (?, ?)
-                    """ % self.table_name, (item.identity, self.field_type(value)))
+            return [(item.identity, self.field_type(value)) for value in values]
 
-        conn.commit()
+    def run_many(self, conn: sqlite3.Connection, items):
+        self.insert(conn, [row for item in items for row in self.rows(item)])
+
+    def insert(self, conn: sqlite3.Connection, rows):
+        self._changes += len(rows)
+        conn.executemany("""
+            INSERT INTO %s (OBJECT_ID, VALUE)
+            VALUES (?, ?)
+            """ % self.table_name, rows)
+
+    def remove(self, conn: sqlite3.Connection, identities):
+        identities = list(identities)
+        self._changes += len(identities)
+        conn.executemany("DELETE FROM %s WHERE OBJECT_ID = ?" % self.table_name,
+                         ((identity,) for identity in identities))
 
     def lookup(self, conn: sqlite3.Connection, value: str):
         cur = conn.execute("SELECT OBJECT_ID FROM %s WHERE VALUE = ?"
-                           % self.table_name, self.field_type(value))
+                           % self.table_name, (self.field_type(value),))
         return (x[0] for x in cur)
 
+    def lookup_range(self, conn: sqlite3.Connection, startkey=None, endkey=None,
+                     limit=None, descending=False):
+        low, high = (endkey, startkey) if descending else (startkey, endkey)
+        where = []
+        args = []
+        if low is not None:
+            where.append("VALUE >= ?")
+            args.append(self.field_type(low))
+        if high is not None:
+            where.append("VALUE <= ?")
+            args.append(self.field_type(high))
+        order = "DESC" if descending else "ASC"
+        sql = "SELECT VALUE, OBJECT_ID FROM %s" % self.table_name
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY VALUE %s, OBJECT_ID %s" % (order, order)
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(int(limit))
+        cur = conn.execute(sql, args)
+        return ((x[0], x[1]) for x in cur)
+
     def get_value_by_id(self, conn, identity):
         return (conn.execute("""
             SELECT VALUE FROM %s WHERE OBJECT_ID = ?
             """ % self.table_name, (identity,)).fetchone() or (None,))[0]
 
+    def clear(self, conn: sqlite3.Connection):
+        conn.execute("DELETE FROM %s" % self.table_name)
+        self._stats = None
+
+    def drop(self, conn: sqlite3.Connection):
+        conn.execute("DROP TABLE IF EXISTS %s" % self.table_name)
+        conn.commit()
+
+    def statistics(self, conn: sqlite3.Connection):
+        if self._stats is not None and self._changes <= max(64, self._stats['rows'] // 10):
+            return self._stats
+        rows, distinct, low, high = conn.execute(
+            "SELECT COUNT(*), COUNT(DISTINCT VALUE), MIN(VALUE), MAX(VALUE) FROM %s" % self.table_name).fetchone()
+        frequent = dict(conn.execute(
+            "SELECT VALUE, COUNT(*) AS N FROM %s GROUP BY VALUE ORDER BY N DESC LIMIT ?"
+            % self.table_name, (Index.stats_sample,)))
+        self._stats = {'rows': rows, 'distinct': distinct, 'min': low, 'max': high, 'frequent': frequent}
+        self._changes = 0
+        return self._stats
+
+    def estimate(self, conn: sqlite3.Connection, predicate: Predicate):
+        stats = self.statistics(conn)
+        if not stats['rows']:
+            return 0
+        frequent = stats['frequent']
+        if predicate.values is not None:
+            rest = (stats['rows'] - sum(frequent.values())) / max(stats['distinct'] - len(frequent), 1)
+            return sum(frequent.get(value, rest) for value in predicate.values)
+        low, high = stats['min'], stats['max']
+        if self.field_type is int and high > low:
+            start = low if predicate.low is None else max(predicate.low, low)
+            stop = high if predicate.high is None else min(predicate.high, high)
+            return stats['rows'] * max(stop - start, 0) / (high - low)
+        bounds = (predicate.low is not None) + (predicate.high is not None)
+        return stats['rows'] / 3 ** bounds
+
+    def ids(self, conn: sqlite3.Connection, predicate: Predicate):
+        where, args = predicate.sql()
+        cur = conn.execute("SELECT DISTINCT OBJECT_ID FROM %s WHERE %s ORDER BY OBJECT_ID"
+                           % (self.table_name, where), args)
+        return (x[0] for x in cur)
+
+    def filter(self, conn: sqlite3.Connection, identities, predicate: Predicate):
+        where, args = predicate.sql()
+        cur = conn.execute("SELECT OBJECT_ID FROM %s WHERE OBJECT_ID IN (%s) AND %s"
+                           % (self.table_name, ', '.join('?' * len(identities)), where),
+                           list(identities) + args)
+        return {x[0] for x in cur}
+
+
+class MemoryIndex(Index):
+    def build(self, conn: sqlite3.Connection):
+        self.existed = False
+        self._ids = {}
+        self._values = {}
+        self._sorted = []
+        log.debug("Initialized in-memory index %s", self.table_name)
+        return self
+
+    def insert(self, conn: sqlite3.Connection, rows):
+        for identity, value in rows:
+            bisect.insort(self._ids.setdefault(value, []), identity)
+            self._values.setdefault(identity, []).append(value)
+        if len(rows) > len(self._sorted) // 8:
+            self._sorted.extend((value, identity) for identity, value in rows)
+            self._sorted.sort()
+        else:
+            for identity, value in rows:
+                bisect.insort(self._sorted, (value, identity))
+
+    def remove(self, conn: sqlite3.Connection, identities):
+        for identity in identities:
+            for value in self._values.pop(identity, ()):
+                ids = self._ids[value]
+                del ids[bisect.bisect_left(ids, identity)]
+                if not ids:
+                    del self._ids[value]
+                del self._sorted[bisect.bisect_left(self._sorted, (value, identity))]
+
+    def lookup(self, conn: sqlite3.Connection, value: str):
+        return iter(list(self._ids.get(self.field_type(value), ())))
+
+    def lookup_range(self, conn: sqlite3.Connection, startkey=None, endkey=None,
+                     limit=None, descending=False):
+        low, high = (endkey, startkey) if descending else (startkey, endkey)
+        start, stop = self._span(Predicate(self.field, low=low, high=high).coerce(self.field_type))
+        rows = self._sorted[start:stop]
+        if descending:
+            rows.reverse()
+        if limit is not None:
+            rows = rows[:int(limit)]
+        return iter(rows)
+
+    def get_value_by_id(self, conn, identity):
+        values = self._values.get(identity)
+        return values[0] if values else None
+
+    def _span(self, predicate: Predicate):
+        rows = self._sorted
+        start, stop = 0, len(rows)
+        if predicate.low is not None:
+            start = bisect.bisect_left(rows, (predicate.low,))
+            while predicate.low_open and start < stop and rows[start][0] == predicate.low:
+                start += 1
+        if predicate.high is not None:
+            stop = bisect.bisect_left(rows, (predicate.high,), lo=start)
+            while not predicate.high_open and stop < len(rows) and rows[stop][0] == predicate.high:
+                stop += 1
+        return start, stop
+
+    def statistics(self, conn: sqlite3.Connection):
+        return {'rows': len(self._sorted), 'distinct': len(self._ids),
+                'min': self._sorted[0][0] if self._sorted else None,
+                'max': self._sorted[-1][0] if self._sorted else None}
+
+    def estimate(self, conn: sqlite3.Connection, predicate: Predicate):
+        if predicate.values is not None:
+            return sum(len(self._ids.get(value, ())) for value in predicate.values)
+        start, stop = self._span(predicate)
+        return max(stop - start, 0)
+
+    def ids(self, conn: sqlite3.Connection, predicate: Predicate):
+        if predicate.values is not None:
+            found = {identity for value in predicate.values for identity in self._ids.get(value, ())
+                     if predicate.matches(value)}
+        else:
+            start, stop = self._span(predicate)
+            found = {identity for _, identity in self._sorted[start:stop]}
+        return iter(sorted(found))
+
+    def filter(self, conn: sqlite3.Connection, identities, predicate: Predicate):
+        return {identity for identity in identities
+                if any(predicate.matches(value) for value in self._values.get(identity, ()))}
+
+    def clear(self, conn: sqlite3.Connection):
+        self._ids.clear()
+        self._values.clear()
+        del self._sorted[:]
+
+    def drop(self, conn: sqlite3.Connection):
+        self.clear(conn)
+
+
+class TermIndex(Index):
+    words = re.compile(r'\w+')
+
+    def __init__(self, schema, name, field=None, fn=None, field_type=str):
+        super().__init__(schema, name, field=field, fn=fn or self.terms, field_type=str)
+
+    def terms(self, value):
+        return TermIndex.words.findall(str(value).lower())
+
+    def rows(self, item: Item):
+        if type(item) is Item:
+            values = [item.value]
+        else:
+            values = item.value
+        return [(item.identity, term) for value in values for term in self.fn(value)]
+
+
+class TokenIndex(TermIndex):
+    kind = 'token'
+
+    def search(self, conn: sqlite3.Connection, text, limit=None, match='any'):
+        terms = sorted(set(self.terms(text)))
+        if not terms:
+            return iter(())
+        sql = """
+            SELECT OBJECT_ID FROM %s WHERE VALUE IN (%s)
+            GROUP BY OBJECT_ID
+            """ % (self.table_name, ', '.join('?' * len(terms)))
+        args = list(terms)
+        if match == 'all':
+            sql += " HAVING COUNT(DISTINCT VALUE) = ?"
+            args.append(len(terms))
+        sql += " ORDER BY COUNT(DISTINCT VALUE) DESC, COUNT(*) DESC, OBJECT_ID"
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(int(limit))
+        return (x[0] for x in conn.execute(sql, args))
+
+
+class PrefixIndex(TermIndex):
+    kind = 'prefix'
+
+    def terms(self, value):
+        return set(super().terms(value))
+
+    def search(self, conn: sqlite3.Connection, text, limit=None):
+        prefix = str(text).lower()
+        sql = """
+            SELECT OBJECT_ID, MIN(VALUE) AS TERM FROM %s WHERE VALUE >= ? AND VALUE < ?
+            GROUP BY OBJECT_ID ORDER BY TERM, OBJECT_ID
+            """ % self.table_name
+        args = [prefix, prefix + '\U0010ffff']
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(int(limit))
+        return (x[0] for x in conn.execute(sql, args))
+
+
+class TrigramIndex(TermIndex):
+    kind = 'trigram'
+
+    def terms(self, value):
+        text = str(value).lower()
+        if len(text) < 3:
+            return {text}
+        return {text[i:i+3] for i in range(len(text) - 2)}
+
+    def candidates(self, conn: sqlite3.Connection, text):
+        text = str(text).lower()
+        if len(text) < 3:
+            cur = conn.execute("SELECT DISTINCT OBJECT_ID FROM %s WHERE instr(VALUE, ?) > 0 ORDER BY OBJECT_ID"
+                               % self.table_name, (text,))
+        else:
+            grams = sorted(self.terms(text))
+            cur = conn.execute("""
+                SELECT OBJECT_ID FROM %s WHERE VALUE IN (%s)
+                GROUP BY OBJECT_ID HAVING COUNT(DISTINCT VALUE) = ? ORDER BY OBJECT_ID
+                """ % (self.table_name, ', '.join('?' * len(grams))), grams + [len(grams)])
+        return (x[0] for x in cur)
+
+
+INDEX_BACKENDS = {
+    'sqlite': Index,
+    'memory': MemoryIndex,
+}
+
+INDEX_KINDS = {
+    'token': TokenIndex,
+    'prefix': PrefixIndex,
+    'trigram': TrigramIndex,
+}
+
+
+def collate(key):
+    if key is None:
+        return b'\x01'
+    elif type(key) is bool:
+        return b'\x02' + (b'\x01' if key else b'\x00')
+    elif type(key) in (int, float):
+        data = bytearray(struct.pack('>d', float(key)))
+        if data[0] & 0x80:
+            data = bytearray(b ^ 0xFF for b in data)
+        else:
+            data[0] |= 0x80
+        return b'\x03' + bytes(data)
+    elif type(key) is str:
+        return b'\x04' + key.encode('utf-8').replace(b'\x00', b'\x00\xff') + b'\x00\x00'
+    elif type(key) in (tuple, list):
+        return b'\x05' + b''.join(collate(k) for k in key) + b'\x00'
+    raise TypeError("Unsupported view key type %s" % type(key).__name__)
+
+
+class View:
+    clean = re.compile('[^A-Z_]')
+
+    def __init__(self, name, map_fn, reduce_fn=None):
+        self.name = name
+        self.map_fn = map_fn
+        self.reduce_fn = reduce_fn
+        self._reduced = {}
+
+    @property
+    def table_name(self):
+        return 'VIEW_' + View.clean.sub('', self.name.upper())
+
+    def build(self, conn: sqlite3.Connection):
+        conn.execute("DROP TABLE IF EXISTS %s" % self.table_name)
+        conn.execute("""
+            CREATE TABLE %s (
+                ID INTEGER PRIMARY KEY AUTOINCREMENT,
+                OBJECT_ID VARCHAR(64) NOT NULL,
+                KEY BLOB NOT NULL,
+                KEY_DATA BLOB,
+                VALUE BLOB
+            )
+            """ % self.table_name)
+        conn.execute("CREATE INDEX %s_KEY ON %s (KEY, OBJECT_ID)" % (self.table_name, self.table_name))
+        conn.execute("CREATE INDEX %s_OBJECT_ID ON %s (OBJECT_ID)" % (self.table_name, self.table_name))
+        conn.commit()
+        log.debug("Initialized view %s", self.table_name)
+        return self
+
+    def emit(self, doc):
+        try:
+            result = self.map_fn(doc)
+            if isinstance(result, types.GeneratorType):
+                return list(result)
+        except KeyError:
+            return []
+        if result is None:
+            return []
+        return [result]
+
+    def remove(self, conn: sqlite3.Connection, identity):
+        for key, in conn.execute("SELECT KEY FROM %s WHERE OBJECT_ID = ?" % self.table_name, (identity,)):
+            self._reduced.pop(key, None)
+        self._reduced.pop(None, None)
+        conn.execute("DELETE FROM %s WHERE OBJECT_ID = ?" % self.table_name, (identity,))
+
+    def rows(self, identity, doc):
+        try:
+            return [(identity, collate(key), pickle.dumps(key), pickle.dumps(value))
+                    for key, value in self.emit(doc)]
+        except Exception:
+            log.warning("View %s skipped %s", self.name, identity, exc_info=True)
+            return []
+
+    def update(self, conn: sqlite3.Connection, identity, doc):
+        self.remove(conn, identity)
+        if doc is None:
+            return
+        rows = self.rows(identity, doc)
+        for _, blob, _, _ in rows:
+            self._reduced.pop(blob, None)
+        conn.executemany("""
+            INSERT INTO %s (OBJECT_ID, KEY, KEY_DATA, VALUE)
+            VALUES (?, ?, ?, ?)
+            """ % self.table_name, rows)
+
+    def _select(self, conn, key, startkey, endkey, skip, limit, descending):
+        where = []
+        args = []
+        if key is not None:
+            where.append("KEY = ?")
+            args.append(collate(key))
+        low, high = (endkey, startkey) if descending else (startkey, endkey)
+        if low is not None:
+            where.append("KEY >= ?")
+            args.append(collate(low))
+        if high is not None:
+            where.append("KEY <= ?")
+            args.append(collate(high))
+        order = "DESC" if descending else "ASC"
+        sql = "SELECT OBJECT_ID, KEY, KEY_DATA, VALUE FROM %s" % self.table_name
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY KEY %s, OBJECT_ID %s, ID %s" % (order, order, order)
+        if limit is not None or skip:
+            sql += " LIMIT ? OFFSET ?"
+            args.extend((-1 if limit is None else int(limit), int(skip or 0)))
+        return conn.execute(sql, args)
+
+    def query(self, conn: sqlite3.Connection, key=None, startkey=None, endkey=None,
+              skip=0, limit=None, descending=False, group=False, reduce=True):
+        if self.reduce_fn is None or not reduce:
+            for identity, _, key_data, value in self._select(conn, key, startkey, endkey,
+                                                             skip, limit, descending):
+                yield {'id': identity, 'key': pickle.loads(key_data), 'value': pickle.loads(value)}
+            return
+
+        cur = self._select(conn, key, startkey, endkey, 0, None, descending)
+        if not group:
+            ranged = key is not None or startkey is not None or endkey is not None
+            if ranged or None not in self._reduced:
+                keys, values = [], []
+                for identity, _, key_data, value in cur:
+                    keys.append([pickle.loads(key_data), identity])
+                    values.append(pickle.loads(value))
+                result = self.reduce_fn(keys, values, False)
+                if ranged:
+                    yield {'key': None, 'value': result}
+                    return
+                self._reduced[None] = result
+            yield {'key': None, 'value': self._reduced[None]}
+            return
+
+        count = 0
+        skip = skip or 0
+        for blob, key_data, rows in self._groups(cur):
+            if skip:
+                skip -= 1
+                continue
+            if limit is not None and count >= limit:
+                return
+            if blob not in self._reduced:
+                keys = [[pickle.loads(k), identity] for identity, k, _ in rows]
+                values = [pickle.loads(value) for _, _, value in rows]
+                self._reduced[blob] = self.reduce_fn(keys, values, False)
+            count += 1
+            yield {'key': pickle.loads(key_data), 'value': self._reduced[blob]}
+
+    def _groups(self, cur):
+        current = None
+        rows = []
+        for identity, blob, key_data, value in cur:
+            if current is not None and blob != current[0]:
+                yield current[0], current[1], rows
+                rows = []
+            if current is None or blob != current[0]:
+                current = (blob, key_data)
+            rows.append((identity, key_data, value))
+        if current is not None:
+            yield current[0], current[1], rows
+
 
 class Chunk:
     def __init__(self, identity, size=2 << 16):
@@ -207,6 +1090,7 @@ class Chunk:
         self.size = size
         self._data = bytearray(size)
         self._position = 0
+        self.live = 0
 
     def set(self, data: bytes):
         assert type(data) is bytes
@@ -216,84 +1100,2128 @@ class Chunk:
         self._data[self._position:self._position+size] = data
         start = self._position
         self._position += size
+        self.live += size
         return (start, size)
 
     def get(self, position, size):
-        return self._data[position:position+size]
+        return memoryview(self._data)[position:position+size]
 
+    @property
+    def free(self):
+        return self.size - self._position
 
-class AboutDB:
+    @property
+    def dead(self):
+        return self._position - self.live
+
+    def release(self):
+        self._data = bytearray()
+        self.size = 0
+        self._position = 0
+        self.live = 0
+
+
+class MappedChunk(Chunk):
+    def __init__(self, identity, path, size=2 << 16, position=0, live=0, durable=False):
+        self.identity = identity
+        self.path = path
+        self.size = size
+        self._position = position
+        self.live = live
+        self.durable = durable
+        self.reclaim = False
+        if not size:
+            self._file = None
+            self._data = bytearray()
+            return
+        self._file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        if os.fstat(self._file.fileno()).st_size < size:
+            self._file.truncate(size)
+        self._data = mmap.mmap(self._file.fileno(), size)
+
+    def flush(self):
+        if self.size:
+            self._data.flush()
+
+    def close(self):
+        if self.size:
+            self._data.close()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def release(self):
+        self.close()
+        self.reclaim = True
+        super().release()
+
+
+class ChunkPool:
+    def __init__(self, chunk_size=2 << 16, growth=1.0, max_chunk_size=None, path=None, chunks=None):
+        if chunk_size <= 0:
+            raise ValueError("Chunk size must be positive")
+        if growth < 1.0:
+            raise ValueError("Growth factor must be at least 1.0")
+        self.chunk_size = chunk_size
+        self.growth = growth
+        self.max_chunk_size = max_chunk_size
+        self.path = path
+        self._chunks = []
+        self._free = []
+        if chunks:
+            for size, position, live in chunks:
+                self._chunks.append(MappedChunk(
+                    len(self._chunks), self._chunk_path(len(self._chunks)),
+                    size=size, position=position, live=live, durable=True))
+            self._active = self._chunks[-1]
+            self._collect()
+        else:
+            self._active = self._allocate(chunk_size)
+
+    def _chunk_path(self, identity):
+        return os.path.join(self.path, 'chunk-%06d.dat' % identity)
+
+    def __getitem__(self, identity):
+        return self._chunks[identity]
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    @property
+    def active(self):
+        return self._active
+
+    def _next_size(self, needed):
+        size = int(self._active.size * self.growth)
+        if self.max_chunk_size is not None:
+            size = min(size, self.max_chunk_size)
+        return max(size, self.chunk_size, needed)
+
+    def _allocate(self, size):
+        identity = self._free.pop() if self._free else len(self._chunks)
+        if self.path is None:
+            chunk = Chunk(identity, size=size)
+        else:
+            chunk = MappedChunk(identity, self._chunk_path(identity), size=size)
+        if identity < len(self._chunks):
+            self._chunks[identity] = chunk
+        else:
+            self._chunks.append(chunk)
+        log.debug("Allocated chunk %d of %d bytes", chunk.identity, size)
+        return chunk
+
+    def set(self, data: bytes):
+        if len(data) > self._active.free:
+            self._active = self._allocate(self._next_size(len(data)))
+        position, size = self._active.set(data)
+        return (self._active.identity, position, size)
+
+    def set_many(self, payloads):
+        results = []
+        run = []
+        run_size = 0
+        for data in payloads:
+            if run_size + len(data) > self._active.free:
+                self._write_run(run, results)
+                run = []
+                run_size = 0
+                if len(data) > self._active.free:
+                    self._active = self._allocate(self._next_size(len(data)))
+            run.append(data)
+            run_size += len(data)
+        self._write_run(run, results)
+        return results
+
+    def _write_run(self, run, results):
+        if not run:
+            return
+        position, _ = self._active.set(b''.join(run))
+        for data in run:
+            results.append((self._active.identity, position, len(data)))
+            position += len(data)
+
+    def discard(self, pointer):
+        if isinstance(pointer, Pointer):
+            self._chunks[pointer.chunk].live -= pointer.size
+
+    def flush(self):
+        for chunk in self._chunks:
+            if isinstance(chunk, MappedChunk):
+                chunk.flush()
+
+    def close(self):
+        for chunk in self._chunks:
+            if isinstance(chunk, MappedChunk):
+                chunk.close()
+
+    def restore(self, chunks, f):
+        self.close()
+        self._chunks = []
+        self._free = []
+        for size, position, live in chunks:
+            chunk = self._allocate(size)
+            if position:
+                view = memoryview(chunk._data)[:position]
+                if f.readinto(view) != position:
+                    raise ValueError("Truncated snapshot chunk %d" % chunk.identity)
+                view.release()
+            chunk._position = position
+            chunk.live = live
+            chunk.durable = True
+        self._active = self._chunks[-1] if self._chunks else self._allocate(self.chunk_size)
+        self._collect()
+
+    def _collect(self):
+        self._free = [chunk.identity for chunk in self._chunks if not chunk.size]
+        for identity in self._free:
+            if self.path is not None and os.path.exists(self._chunk_path(identity)):
+                os.remove(self._chunk_path(identity))
+
+    def release(self, chunk):
+        chunk.release()
+        if not isinstance(chunk, MappedChunk):
+            self._free.append(chunk.identity)
+        elif not chunk.durable:
+            os.remove(chunk.path)
+            chunk.reclaim = False
+            self._free.append(chunk.identity)
+
+    def reclaim(self):
+        for chunk in self._chunks:
+            if getattr(chunk, 'reclaim', False):
+                if os.path.exists(chunk.path):
+                    os.remove(chunk.path)
+                chunk.reclaim = False
+                self._free.append(chunk.identity)
+            elif chunk.size:
+                chunk.durable = True
+
+    def candidates(self, threshold):
+        for chunk in self._chunks:
+            if chunk is self._active or chunk.size == 0:
+                continue
+            if chunk._position and chunk.dead >= threshold * chunk._position:
+                yield chunk
+
+
+_missing = object()
+
+
+class Metrics:
     def __init__(self):
-        self._chunk = [Chunk(0)]
+        self.counts = {}
+        self.totals = {}
+        self.histograms = {}
+        self.hooks = []
+        self._lock = threading.Lock()
+
+    def record(self, op, seconds):
+        bucket = min(int(seconds * 1e6).bit_length(), 39)
+        with self._lock:
+            self.counts[op] = self.counts.get(op, 0) + 1
+            self.totals[op] = self.totals.get(op, 0.0) + seconds
+            histogram = self.histograms.get(op)
+            if histogram is None:
+                histogram = self.histograms[op] = [0] * 40
+            histogram[bucket] += 1
+        for hook in self.hooks:
+            hook(op, seconds)
+
+    @contextmanager
+    def timer(self, op):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(op, time.perf_counter() - start)
+
+    def percentile(self, op, fraction):
+        histogram = self.histograms.get(op)
+        if not histogram:
+            return None
+        target = fraction * self.counts[op]
+        seen = 0
+        for bucket, count in enumerate(histogram):
+            seen += count
+            if seen >= target:
+                return (1 << bucket) / 1e6
+        return None
+
+    def stats(self):
+        result = {}
+        for op, count in self.counts.items():
+            result[op] = {
+                'count': count,
+                'total': self.totals[op],
+                'p50': self.percentile(op, 0.5),
+                'p99': self.percentile(op, 0.99),
+                'histogram': {(1 << bucket) / 1e6: n for bucket, n in enumerate(self.histograms[op]) if n},
+            }
+        return result
+
+    def reset(self):
+        self.counts.clear()
+        self.totals.clear()
+        self.histograms.clear()
+
+
+class RWLock:
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._waiting_writers = 0
+        self._local = threading.local()
+
+    def _held(self):
+        return getattr(self._local, 'reads', 0)
+
+    @contextmanager
+    def read(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me and not self._held():
+                while self._writer is not None or self._waiting_writers:
+                    self._cond.wait()
+            self._readers += 1
+        self._local.reads = self._held() + 1
+        try:
+            yield
+        finally:
+            self._local.reads -= 1
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._local.writes += 1
+            else:
+                if self._held():
+                    raise RuntimeError("Cannot upgrade a read lock to a write lock")
+                self._waiting_writers += 1
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+                self._waiting_writers -= 1
+                self._writer = me
+                self._local.writes = 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._local.writes -= 1
+                if not self._local.writes:
+                    self._writer = None
+                    self._cond.notify_all()
+
+
+class TimedConnection(sqlite3.Connection):
+    metrics = None
+
+    def execute(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            self.metrics.record('sqlite', time.perf_counter() - start)
+
+    def executemany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            self.metrics.record('sqlite', time.perf_counter() - start)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            self.metrics.record('sqlite', time.perf_counter() - start)
+
+
+def locked(write):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            if self._lock is None:
+                return fn(self, *args, **kwargs)
+            with (self._lock.write() if write else self._lock.read()):
+                return fn(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed(op):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(self, *args, **kwargs)
+            finally:
+                self._metrics.record(op, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class LRUCache:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'capacity': self.capacity}
+
+
+class Aggregate:
+    def __init__(self, schema, field):
+        self.schema = schema
+        self.field = field
+        self.stale = True
+
+    def reset(self, values):
+        self.count = len(values)
+        self.sum = sum(values)
+        self.min = min(values) if values else None
+        self.max = max(values) if values else None
+        self.stale = False
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def remove(self, value):
+        self.count -= 1
+        self.sum -= value
+        if value == self.min or value == self.max:
+            self.stale = True
+
+    def result(self):
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max}
+
+
+class Compactor:
+    def __init__(self, pool: ChunkPool, register, threshold=0.5, on_move=None):
+        self.pool = pool
+        self.register = register
+        self.threshold = threshold
+        self.on_move = on_move
+        self._victim = None
+        self._pending = None
+        self.moved = 0
+        self.released = 0
+
+    def step(self, budget=100):
+        while budget > 0:
+            if self._victim is None:
+                self._victim = next(self.pool.candidates(self.threshold), None)
+                if self._victim is None:
+                    return False
+                log.debug("Compacting chunk %d", self._victim.identity)
+                self._pending = iter(self.register.members(self._victim.identity))
+
+            for identity in self._pending:
+                budget -= 1
+                self._move(identity)
+                if budget <= 0:
+                    return True
+
+            self.pool.release(self._victim)
+            self.released += 1
+            self._victim = None
+            self._pending = None
+        return True
+
+    def _move(self, identity):
+        if identity not in self.register:
+            return
+        victim = self._victim.identity
+        for field, pointer in self.register.get(identity).items():
+            if not isinstance(pointer, Pointer) or pointer.chunk != victim:
+                continue
+            data = bytes(self._victim.get(pointer.position, pointer.size))
+            chunk, position, size = self.pool.set(data)
+            self._victim.live -= pointer.size
+            self.register.set(identity, field, Pointer(chunk, pointer.type, position, size))
+            self.moved += 1
+            if self.on_move is not None:
+                self.on_move(identity, pointer)
+
+
+class PointerTable:
+    magic = b'ABDB'
+    version = 4
+
+    header = struct.Struct('>4sHIQ')
+    header_v2 = struct.Struct('>4sHI')
+    chunk = struct.Struct('>QQQ')
+    count = struct.Struct('>Q')
+    pointer = struct.Struct('>IBQI')
+    length = struct.Struct('>H')
+
+    def __init__(self, path):
+        self.path = path
+        self.generation = 0
+
+    def _write_str(self, f, value):
+        data = value.encode('utf-8')
+        f.write(PointerTable.length.pack(len(data)))
+        f.write(data)
+
+    def _read_str(self, data, offset):
+        size, = PointerTable.length.unpack_from(data, offset)
+        offset += PointerTable.length.size
+        return data[offset:offset+size].decode('utf-8'), offset + size
+
+    def dump(self, f, pool: ChunkPool, register: Register, generation=0):
+        f.write(PointerTable.header.pack(PointerTable.magic, PointerTable.version, len(pool), generation))
+        for chunk in pool:
+            f.write(PointerTable.chunk.pack(chunk.size, chunk._position, chunk.live))
+        entries = list(register.items())
+        f.write(PointerTable.count.pack(len(entries)))
+        for identity, field, pointer in entries:
+            self._write_str(f, identity)
+            self._write_str(f, field)
+            if isinstance(pointer, Link):
+                f.write(b'L')
+                self._write_str(f, pointer.identity)
+            else:
+                f.write(b'P')
+                f.write(PointerTable.pointer.pack(
+                    pointer.chunk, TYPES.index(pointer.type),
+                    pointer.position, pointer.size))
+        order = register.order()
+        f.write(PointerTable.count.pack(register._last_sequence))
+        f.write(PointerTable.count.pack(len(order)))
+        for sequence, identity in order:
+            f.write(PointerTable.count.pack(sequence))
+            self._write_str(f, identity)
+        return len(entries)
+
+    def write(self, pool: ChunkPool, register: Register, generation=0):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            count = self.dump(f, pool, register, generation)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.generation = generation
+        log.debug("Wrote pointer table generation %d with %d entries", generation, count)
+
+    def read(self, register: Register):
+        with open(self.path, 'rb') as f:
+            return self.load(f.read(), register)
+
+    def load(self, data, register: Register):
+        magic, version, chunk_count = PointerTable.header_v2.unpack_from(data, 0)
+        if magic != PointerTable.magic or version not in (2, 3, PointerTable.version):
+            raise ValueError("Not an aboutdb pointer table: %s" % self.path)
+        if version == 2:
+            self.generation = 0
+            offset = PointerTable.header_v2.size
+        else:
+            self.generation = PointerTable.header.unpack_from(data, 0)[3]
+            offset = PointerTable.header.size
+        chunks = []
+        for _ in range(chunk_count):
+            chunks.append(PointerTable.chunk.unpack_from(data, offset))
+            offset += PointerTable.chunk.size
+        entry_count, = PointerTable.count.unpack_from(data, offset)
+        offset += PointerTable.count.size
+        for _ in range(entry_count):
+            identity, offset = self._read_str(data, offset)
+            field, offset = self._read_str(data, offset)
+            kind = data[offset:offset+1]
+            offset += 1
+            if kind == b'L':
+                target, offset = self._read_str(data, offset)
+                register.set(identity, field, Link(target))
+            else:
+                chunk, type_tag, position, size = PointerTable.pointer.unpack_from(data, offset)
+                offset += PointerTable.pointer.size
+                register.set(identity, field, Pointer(chunk, TYPES[type_tag], position, size))
+        if version >= 4:
+            last_sequence, order_count = struct.unpack_from('>QQ', data, offset)
+            offset += 2 * PointerTable.count.size
+            order = []
+            for _ in range(order_count):
+                sequence, = PointerTable.count.unpack_from(data, offset)
+                identity, offset = self._read_str(data, offset + PointerTable.count.size)
+                order.append((sequence, identity))
+            register.restore_order(last_sequence, order)
+        return chunks
+
+
+class Snapshot:
+    magic = b'ABSN'
+    version = 1
+    header = struct.Struct('>4sHQ')
+
+
+_markers = ({'_link'}, {'_bytes'}, {'_dict'}, {'_items'})
+
+
+def _to_json(value):
+    if type(value) is bytes:
+        return {'_bytes': base64.b64encode(value).decode('ascii')}
+    elif type(value) is list:
+        return [_to_json(v) for v in value]
+    elif type(value) is dict:
+        if any(type(k) is not str for k in value):
+            return {'_items': [[_to_json(k), _to_json(v)] for k, v in value.items()]}
+        result = {k: _to_json(v) for k, v in value.items()}
+        return {'_dict': result} if set(value) in _markers else result
+    return value
+
+
+def _from_json(value):
+    if type(value) is dict:
+        if set(value) == {'_bytes'}:
+            return base64.b64decode(value['_bytes'])
+        if set(value) == {'_items'}:
+            return {_from_json(k): _from_json(v) for k, v in value['_items']}
+        if set(value) == {'_dict'}:
+            value = value['_dict']
+        return {k: _from_json(v) for k, v in value.items()}
+    elif type(value) is list:
+        return [_from_json(v) for v in value]
+    return value
+
+
+class Scan:
+    cursor_format = struct.Struct('>Q')
+
+    def __init__(self, db, schema=None, fields=None, batch_size=1000, after=None, depth=0, render=None):
+        self.db = db
+        self.schema = schema
+        self.fields = fields
+        self.batch_size = batch_size
+        self.depth = depth
+        self.render = render
+        self._sequence = Scan.decode_cursor(after)
+        self._rows = iter(())
+        self._end = None
+
+    @staticmethod
+    def decode_cursor(cursor):
+        if cursor is None:
+            return 0
+        try:
+            return Scan.cursor_format.unpack(base64.urlsafe_b64decode(cursor))[0]
+        except (ValueError, struct.error):
+            raise ValueError("Invalid scan cursor %r" % cursor)
+
+    @property
+    def cursor(self):
+        return base64.urlsafe_b64encode(Scan.cursor_format.pack(self._sequence)).decode('ascii')
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        for sequence, row in self._rows:
+            self._sequence = sequence
+            return row
+        if self._end is not None:
+            self._sequence = self._end
+        rows, self._end = self.db._scan_batch(self._sequence, self.batch_size, self.schema, self.fields,
+                                              self.depth, self.render)
+        if not rows:
+            self._sequence = self._end
+            raise StopIteration
+        self._rows = iter(rows)
+        return next(self)
+
+
+class WriteAheadLog:
+    SET, UNSET, LINK, DELETE = range(4)
+    magic = b'ABWL'
+    header = struct.Struct('>4sQ')
+    frame = struct.Struct('>II')
+    modes = ('always', 'interval', 'never')
+
+    def __init__(self, path, durability='interval', interval=0.1, generation=0):
+        if durability not in WriteAheadLog.modes:
+            raise ValueError("Unknown durability mode %r" % durability)
+        self.path = path
+        self.durability = durability
+        self.interval = interval
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._file = open(path, 'ab')
+        self.generation = generation
+        if self._file.tell() < WriteAheadLog.header.size:
+            self._reset(generation)
+        else:
+            with open(path, 'rb') as f:
+                magic, self.generation = WriteAheadLog.header.unpack(f.read(WriteAheadLog.header.size))
+            if magic != WriteAheadLog.magic:
+                raise ValueError("Not an aboutdb write-ahead log: %s" % path)
+        self._stop = threading.Event()
+        self._syncer = None
+        if durability == 'interval':
+            self._syncer = threading.Thread(target=self._sync_loop, name='aboutdb-wal', daemon=True)
+            self._syncer.start()
+
+    def append(self, op, *args):
+        payload = encode([op, list(args)])
+        with self._lock:
+            self._buffer += WriteAheadLog.frame.pack(len(payload), zlib.crc32(payload))
+            self._buffer += payload
+
+    def commit(self):
+        with self._lock:
+            if not self._buffer:
+                return
+            self._file.write(self._buffer)
+            self._file.flush()
+            self._buffer = bytearray()
+            if self.durability == 'always':
+                os.fsync(self._file.fileno())
+            else:
+                self._dirty = True
+
+    def sync(self):
+        with self._lock:
+            if self._dirty:
+                os.fsync(self._file.fileno())
+                self._dirty = False
+
+    def _sync_loop(self):
+        while not self._stop.wait(self.interval):
+            self.sync()
+
+    def replay(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        offset = WriteAheadLog.header.size
+        while offset + WriteAheadLog.frame.size <= len(data):
+            size, crc = WriteAheadLog.frame.unpack_from(data, offset)
+            start = offset + WriteAheadLog.frame.size
+            payload = data[start:start+size]
+            if len(payload) < size or zlib.crc32(payload) != crc:
+                break
+            op, args = decode(payload)
+            yield op, args
+            offset = start + size
+        if offset < len(data):
+            log.warning("Discarding %d bytes of torn write-ahead log", len(data) - offset)
+            with self._lock:
+                self._file.truncate(offset)
+
+    def _reset(self, generation):
+        self._file.truncate(0)
+        self._file.write(WriteAheadLog.header.pack(WriteAheadLog.magic, generation))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.generation = generation
+        self._dirty = False
+
+    def truncate(self, generation):
+        with self._lock:
+            self._buffer = bytearray()
+            self._reset(generation)
+
+    def close(self):
+        self._stop.set()
+        if self._syncer is not None:
+            self._syncer.join()
+        self.commit()
+        self.sync()
+        self._file.close()
+
+
+class AboutDB:
+    def __init__(self, chunk_size=2 << 16, chunk_growth=1.0, max_chunk_size=None,
+                 compact_threshold=0.5, path=None, compact_register=False,
+                 cache_size=1024, value_cache_size=4096, concurrent=False,
+                 durability='interval', sync_interval=0.1):
+        self.path = path
+        self.concurrent = concurrent
+        self._lock = RWLock() if concurrent else None
+        self._local = threading.local()
+        self._connections = []
+        self._register = CompactRegister() if compact_register else Register()
+        chunks = None
+        if path is None:
+            self._pointer_table = None
+            if concurrent:
+                self._index_db_uri = 'file:aboutdb-%x?mode=memory&cache=shared' % id(self)
+            else:
+                self._index_db_uri = ':memory:'
+        else:
+            os.makedirs(path, exist_ok=True)
+            self._pointer_table = PointerTable(os.path.join(path, 'register.tbl'))
+            if os.path.exists(self._pointer_table.path):
+                chunks = self._pointer_table.read(self._register)
+            self._index_db_uri = 'file:%s' % urllib.parse.quote(os.path.abspath(os.path.join(path, 'index.db')))
+            if concurrent:
+                self._index_db_uri += '?cache=shared'
+        self._metrics = Metrics()
+        self._main_conn = self._connect()
+        self._chunk = ChunkPool(chunk_size, growth=chunk_growth, max_chunk_size=max_chunk_size,
+                                path=path, chunks=chunks)
         self._index = []
-        self._index_db_conn = sqlite3.connect(':memory:')
-        self._register = Register()
+        self._index_by_key = {}
+        self._index_tables = {}
+        self._views = {}
+        self._aggregates = {}
+        self._doc_cache = LRUCache(cache_size)
+        self._value_cache = LRUCache(value_cache_size)
+        self._compactor = Compactor(self._chunk, self._register, threshold=compact_threshold,
+                                    on_move=self._moved)
+        self._wal = None
+        self._replayed = set()
         self.index(None, '*schema')
+        if path is not None:
+            self._wal = WriteAheadLog(os.path.join(path, 'wal.log'), durability=durability,
+                                      interval=sync_interval, generation=self._pointer_table.generation)
+            self._replay()
+
+    def _replay(self):
+        if self._wal.generation < self._pointer_table.generation:
+            log.info("Write-ahead log generation %d is covered by checkpoint %d",
+                     self._wal.generation, self._pointer_table.generation)
+            self._wal.truncate(self._pointer_table.generation)
+            return
+        wal, self._wal = self._wal, None
+        count = 0
+        try:
+            for op, args in wal.replay():
+                if op == WriteAheadLog.SET:
+                    self._write([List(*args) if type(args[2]) is list else Item(*args)])
+                elif op == WriteAheadLog.UNSET:
+                    self.unset(*args)
+                elif op == WriteAheadLog.LINK:
+                    self.link(*args)
+                elif op == WriteAheadLog.DELETE:
+                    self.delete(*args)
+                self._replayed.add(args[0])
+                count += 1
+        finally:
+            self._wal = wal
+        if count:
+            log.info("Replayed %d write-ahead log records", count)
+
+    def _log(self, op, *args):
+        if self._wal is not None:
+            self._wal.append(op, *args)
+
+    def _connect(self):
+        conn = sqlite3.connect(self._index_db_uri, uri=True, check_same_thread=not self.concurrent,
+                               factory=TimedConnection)
+        conn.metrics = self._metrics
+        self._connections.append(conn)
+        return conn
+
+    @property
+    def _index_db_conn(self):
+        if not self.concurrent:
+            return self._main_conn
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    @property
+    def _batch(self):
+        return getattr(self._local, 'batch', None)
+
+    @_batch.setter
+    def _batch(self, items):
+        self._local.batch = items
+
+    @property
+    def _deferred(self):
+        return getattr(self._local, 'deferred', None)
+
+    @_deferred.setter
+    def _deferred(self, identities):
+        self._local.deferred = identities
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @locked(write=True)
+    def flush(self):
+        if self._pointer_table is None:
+            return
+        self._chunk.flush()
+        generation = self._pointer_table.generation + 1
+        self._pointer_table.write(self._chunk, self._register, generation)
+        self._index_db_conn.commit()
+        self._chunk.reclaim()
+        if self._wal is not None:
+            self._wal.truncate(generation)
+        self._replayed.clear()
+
+    checkpoint = flush
+
+    @locked(write=True)
+    def close(self):
+        self.flush()
+        if self._wal is not None:
+            self._wal.close()
+        self._chunk.close()
+        for conn in self._connections:
+            conn.close()
+
+    @locked(write=True)
+    def index(self, schema, name, field=None, fn=None, field_type=str, backend='sqlite', kind='value'):
+        if backend not in INDEX_BACKENDS:
+            raise ValueError("Unknown index backend %r" % backend)
+        if kind == 'value':
+            cls = INDEX_BACKENDS[backend]
+        elif kind in INDEX_KINDS and backend == 'sqlite':
+            cls = INDEX_KINDS[kind]
+        else:
+            raise ValueError("Unknown index kind %r for backend %r" % (kind, backend))
+        index = cls(schema, name, field=field, fn=fn, field_type=field_type)
+        owner = self._index_tables.get(index.table_name)
+        if owner is not None and (owner.schema, owner.name) != (index.schema, index.name):
+            raise ValueError("Index %s::%s would share table %s with index %s::%s"
+                             % (index.schema, index.name, index.table_name, owner.schema, owner.name))
+        index.build(self._index_db_conn)
+        try:
+            if not index.existed and len(self._register):
+                self._backfill(index)
+            elif self._replayed:
+                self._backfill(index, self._replayed)
+        except Exception:
+            if not index.existed:
+                index.drop(self._index_db_conn)
+            raise
+        self._index.append(index)
+        self._index_by_key.setdefault((index.schema, index.field), []).append(index)
+        self._index_tables[index.table_name] = index
+
+    @timed('backfill')
+    def _backfill(self, index: Index, identities=None):
+        items = []
+        schemas = {}
+        for identity, field, pointer in self._register.items():
+            if field != index.field or not isinstance(pointer, Pointer):
+                continue
+            if identities is not None and identity not in identities:
+                continue
+            if index.schema is not None:
+                if identity not in schemas:
+                    schemas[identity] = self._schema_of(identity)
+                if schemas[identity] != index.schema:
+                    continue
+            items.append(self._item_for(identity, field))
+        log.debug("Backfilling index %s with %d items", index.table_name, len(items))
+        rows = [row for item in items for row in index.rows(item)]
+        with self._index_db_conn:
+            if identities is not None:
+                index.remove(self._index_db_conn, identities)
+            index.insert(self._index_db_conn, rows)
+
+    def _indexes_for(self, schema, field):
+        indexes = self._index_by_key.get((schema, field), [])
+        if schema is not None:
+            indexes = indexes + self._index_by_key.get((None, field), [])
+        return indexes
+
+    def _index_for(self, schema, field, kind='value'):
+        return next((index for index in self._index_by_key.get((schema, field), ()) if index.kind == kind), None)
+
+    @locked(write=True)
+    def define(self, name, map_fn, reduce_fn=None):
+        view = View(name, map_fn, reduce_fn).build(self._index_db_conn)
+        self._views[name] = view
+        with self._index_db_conn:
+            for identity in self._register.identities():
+                view.update(self._index_db_conn, identity, self.get(identity, depth=0))
+
+    @locked(write=False)
+    def view(self, name, key=None, startkey=None, endkey=None, include_docs=False,
+             group=False, reduce=True, skip=0, limit=None, descending=False):
+        log.debug("View %s", name)
+        rows = self._views[name].query(self._index_db_conn, key=key, startkey=startkey, endkey=endkey,
+                                       skip=skip, limit=limit, descending=descending,
+                                       group=group, reduce=reduce)
+        if include_docs:
+            rows = self._include_docs(rows)
+        return self._detach(rows)
 
-    def index(self, schema, name, field=None, fn=None):
-        self._index.append(
-            Index(schema, name, field=field, fn=fn)
-            .build(self._index_db_conn))
+    def _include_docs(self, rows):
+        for row in rows:
+            if 'id' in row:
+                row['doc'] = self.get(row['id'])
+            yield row
 
+    def _detach(self, rows):
+        if self.concurrent and rows is not None:
+            return iter(list(rows))
+        return rows
+
+    @timed('view_update')
+    def _update_views(self, identities):
+        if self._deferred is not None:
+            self._deferred.update(identities)
+            return
+        if not self._views:
+            return
+        with self._index_db_conn:
+            for identity in dict.fromkeys(identities):
+                doc = self.get(identity, depth=0) if identity in self._register else None
+                for view in self._views.values():
+                    view.update(self._index_db_conn, identity, doc)
+
+    @timed('set')
     def set(self, identity: str, field: str, value):
+        if type(value) is tuple:
+            value = list(value)
+        elif type(value) in (bytearray, memoryview):
+            value = bytes(value)
         if type(value) is list:
             item = List(identity, field, value)
         else:
             item = Item(identity, field, value)
 
-        logging.debug("Store %s", repr(item))
-        chunk = self._chunk[0]
-        position, size = chunk.set(item.as_bytes())
-        self._register.set(identity, field, Pointer(0, type(value), position, size))
-        # self._run_indexing_on(item)
+        if TRACE:
+            log.debug("Store %r", item)
+        if self._batch is not None:
+            self._batch.append(item)
+        else:
+            self._write([item])
+
+    def set_many(self, items):
+        with self.batch():
+            for identity, field, value in items:
+                self.set(identity, field, value)
 
+    @contextmanager
+    def batch(self):
+        if self._batch is not None:
+            yield self
+            return
+        self._batch = []
+        try:
+            yield self
+            items = self._batch
+        finally:
+            self._batch = None
+        self._write(items)
+
+    def _drain(self):
+        if self._batch:
+            items, self._batch = self._batch, []
+            self._write(items)
+
+    @locked(write=True)
+    @timed('write')
+    def _write(self, items):
+        old_schemas = {item.identity: self._schema_of(item.identity)
+                       for item in items if item.field == '*schema'}
+        plan = self._plan_indexing(items, old_schemas)
+        payloads = encode_many(item.value for item in items)
+        for item in items:
+            self._log(WriteAheadLog.SET, item.identity, item.field, item.value)
+        self._commit()
+        for item, (chunk, position, size) in zip(items, self._chunk.set_many(payloads)):
+            self._doc_cache.pop(item.identity)
+            self._track(item.identity, item.field, item.value)
+            self._discard(item.identity, item.field)
+            self._register.set(item.identity, item.field, Pointer(chunk, type(item.value), position, size))
+        self._run_indexing_on_many(plan, [item.identity for item in items])
+        self._update_views(item.identity for item in items)
+
+    @locked(write=True)
+    @timed('unset')
     def unset(self, identity: str, field: str):
+        self._drain()
+        if field not in self._register.get(identity):
+            raise KeyError(field)
+        self._log(WriteAheadLog.UNSET, identity, field)
+        self._commit()
+        if field == '*schema':
+            self._unindex(identity, list(self._register.get(identity).keys()), schema_only=True)
+        else:
+            self._unindex(identity, [field])
+        self._doc_cache.pop(identity)
+        self._track(identity, field)
+        self._discard(identity, field)
         self._register.unset(identity, field)
+        self._update_views([identity])
 
+    @locked(write=True)
+    @timed('link')
     def link(self, identity: str, field: str, target_identity: str):
+        self._drain()
+        self._log(WriteAheadLog.LINK, identity, field, target_identity)
+        self._commit()
+        if identity in self._register:
+            self._unindex(identity, [field])
+        self._doc_cache.pop(identity)
+        self._track(identity, field)
+        self._discard(identity, field)
         self._register.set(identity, field, Link(target_identity))
+        self._update_views([identity])
 
-    def get(self, identity):
-        logging.debug("Get %s", identity)
-        obj = self._register.get(identity)
-        result = {}
-        pp(obj)
-        for field, pointer in obj.items():
-            if hasattr(pointer, 'identity'):
-                result[field] = self.get(pointer.identity)
+    @locked(write=False)
+    @timed('get')
+    def get(self, identity, depth=None, fields=None):
+        if TRACE:
+            log.debug("Get %s", identity)
+        return self._expand(identity, depth, fields, {})
+
+    def _expand(self, identity, depth, fields, loaded):
+        root = {}
+        path = set()
+        stack = [(root, identity, 0)]
+        while stack:
+            result, current, level = stack.pop()
+            if result is None:
+                path.discard(current)
+                continue
+            path.add(current)
+            stack.append((None, current, level))
+            obj = loaded.get(current)
+            if obj is None:
+                obj = self._doc_cache.get(current)
+                if obj is None:
+                    obj = self._fields_of(current)
+                loaded[current] = obj
+            if current == identity and fields is not None:
+                obj = {field: obj[field] for field in fields if field in obj}
+            for field, value in obj.items():
+                if isinstance(value, Link):
+                    target = value.identity
+                    if target in path or (depth is not None and level >= depth):
+                        result[field] = {'_id': target}
+                    else:
+                        result[field] = {}
+                        stack.append((result[field], target, level + 1))
+                elif isinstance(value, Pointer):
+                    result[field] = self._unpoint(value)
+                else:
+                    result[field] = value
+            result['_id'] = current
+
+        return root
+
+    @locked(write=False)
+    @timed('get_many')
+    def get_many(self, identities, fields=None, depth=None):
+        if TRACE:
+            log.debug("Get many %s", identities)
+        identities = list(identities)
+        loaded = {}
+        fresh = []
+        reads = []
+        for identity in dict.fromkeys(identities):
+            obj = self._doc_cache.get(identity)
+            if obj is None:
+                obj = dict(self._register.get(identity))
+                for field, pointer in obj.items():
+                    if isinstance(pointer, Pointer) and pointer.type not in (list, dict):
+                        reads.append((pointer.chunk, pointer.position, obj, field))
+                fresh.append((identity, obj))
+            loaded[identity] = obj
+
+        reads.sort(key=lambda read: (read[0], read[1]))
+        for _, _, obj, field in reads:
+            obj[field] = self._unpoint(obj[field])
+        for identity, obj in fresh:
+            self._doc_cache.put(identity, obj)
+
+        return [self._expand(identity, depth, fields, loaded) for identity in identities]
+
+    @locked(write=False)
+    def _raw_many(self, identities):
+        results = []
+        for identity in identities:
+            if identity not in self._register:
+                results.append(None)
+                continue
+            results.append({field: pointer if isinstance(pointer, Link) else self._unpoint(pointer)
+                            for field, pointer in self._register.get(identity).items()})
+        return results
+
+    def _fields_of(self, identity):
+        obj = {}
+        for field, pointer in self._register.get(identity).items():
+            if isinstance(pointer, Link) or pointer.type in (list, dict):
+                obj[field] = pointer
             else:
-                result[field] = self._unpoint(pointer)
+                obj[field] = self._unpoint(pointer)
+        self._doc_cache.put(identity, obj)
+        return obj
+
+    @locked(write=False)
+    def stats(self):
+        return {
+            'operations': self._metrics.stats(),
+            'chunks': [{'identity': chunk.identity, 'size': chunk.size, 'written': chunk._position,
+                        'live': chunk.live, 'dead': chunk.dead} for chunk in self._chunk],
+            'sqlite_seconds': self._metrics.totals.get('sqlite', 0.0),
+            'cache': self.cache_stats(),
+        }
 
-        return dict(result, _id=identity)
+    def add_hook(self, hook):
+        self._metrics.hooks.append(hook)
 
+    def remove_hook(self, hook):
+        self._metrics.hooks.remove(hook)
+
+    def cache_stats(self):
+        return {'documents': self._doc_cache.stats(), 'values': self._value_cache.stats()}
+
+    def _moved(self, identity, pointer):
+        self._doc_cache.pop(identity)
+        self._value_cache.pop((pointer.chunk, pointer.position))
+
+    @locked(write=True)
+    @timed('delete')
     def delete(self, identity):
-        logging.debug("Delete %s", identity)
+        if TRACE:
+            log.debug("Delete %s", identity)
+        self._drain()
+        fields = self._register.get(identity)
+        self._log(WriteAheadLog.DELETE, identity)
+        self._commit()
+        self._unindex(identity, list(fields.keys()))
+        self._doc_cache.pop(identity)
+        for field in fields:
+            if field != '*schema':
+                self._track(identity, field)
+        for pointer in fields.values():
+            self._chunk.discard(pointer)
+            if isinstance(pointer, Pointer):
+                self._value_cache.pop((pointer.chunk, pointer.position))
         self._register.delete(identity)
+        self._update_views([identity])
 
-    def lookup(self, schema, field, value):
-        logging.debug("Lookup %s::%s = %s", schema, field, value)
+    @contextmanager
+    def deferred_indexing(self):
+        if self._deferred is not None:
+            yield self
+            return
+        self._deferred = set()
+        try:
+            yield self
+        finally:
+            touched, self._deferred = self._deferred, None
+            self._reindex(touched)
+
+    @locked(write=True)
+    def _reindex(self, identities=None):
+        for aggregate in self._aggregates.values():
+            aggregate.stale = True
         for index in self._index:
-            if index.handles_schema_and_field(schema, field):
-                return index.lookup(self._index_db_conn, value)
+            if identities is None:
+                with self._index_db_conn:
+                    index.clear(self._index_db_conn)
+                self._backfill(index)
+            elif identities:
+                self._backfill(index, identities)
+        if identities is None:
+            identities = self._register.identities()
+        self._update_views(identities)
+
+    def scan(self, schema=None, fields=None, batch_size=1000, after=None, depth=0):
+        return Scan(self, schema=schema, fields=fields, batch_size=batch_size, after=after, depth=depth)
+
+    @locked(write=False)
+    @timed('scan')
+    def _scan_batch(self, after, limit, schema=None, fields=None, depth=0, render=None):
+        rows = []
+        while not rows:
+            batch = self._register.scan(after, limit)
+            if not batch:
+                break
+            after = batch[-1][0]
+            for sequence, identity in batch:
+                if schema is not None and self._schema_of(identity) != schema:
+                    continue
+                if render is not None:
+                    rows.append((sequence, render(identity)))
+                elif fields is None:
+                    rows.append((sequence, self.get(identity, depth=depth)))
+                else:
+                    rows.append((sequence, (identity,) + tuple(self._field_value(identity, field, depth)
+                                                               for field in fields)))
+        return rows, after
+
+    def _field_value(self, identity, field, depth):
+        pointer = self._register.pointer(identity, field)
+        if pointer is None:
+            return None
+        if isinstance(pointer, Link):
+            if depth is not None and depth <= 0:
+                return {'_id': pointer.identity}
+            return self.get(pointer.identity, depth=None if depth is None else depth - 1)
+        return self._unpoint(pointer)
+
+    def import_stream(self, source, batch_size=1000):
+        if hasattr(source, 'read'):
+            source = iter(source.readline, source.read(0))
+        source = iter(source)
+        count = 0
+        with self.deferred_indexing():
+            for chunk in iter(lambda: list(itertools.islice(source, batch_size)), []):
+                links = []
+                with self.batch():
+                    for line in chunk:
+                        if isinstance(line, (str, bytes)):
+                            if not line.strip():
+                                continue
+                            obj = json.loads(line)
+                        else:
+                            obj = dict(line)
+                        if not obj:
+                            continue
+                        identity = obj.pop('_id')
+                        for field, value in obj.items():
+                            if type(value) is dict and set(value) == {'_link'}:
+                                links.append((identity, field, value['_link']))
+                            else:
+                                self.set(identity, field, _from_json(value))
+                        count += 1
+                for identity, field, target in links:
+                    self.link(identity, field, target)
+        return count
+
+    def export_stream(self, f=None):
+        lines = self._export_lines()
+        if f is None:
+            return lines
+        count = 0
+        for line in lines:
+            f.write(line + '\n')
+            count += 1
+        return count
 
+    def _export_lines(self, batch_size=1000):
+        for obj in Scan(self, batch_size=batch_size, render=self._export_object):
+            yield json.dumps(obj, ensure_ascii=False)
+
+    def _export_object(self, identity):
+        obj = {'_id': identity}
+        for field, pointer in self._register.get(identity).items():
+            if isinstance(pointer, Link):
+                obj[field] = {'_link': pointer.identity}
+            else:
+                obj[field] = _to_json(self._unpoint(pointer))
+        return obj
+
+    @locked(write=False)
+    def snapshot(self, f):
+        table = io.BytesIO()
+        PointerTable(None).dump(table, self._chunk, self._register)
+        f.write(Snapshot.header.pack(Snapshot.magic, Snapshot.version, len(table.getvalue())))
+        f.write(table.getvalue())
+        for chunk in self._chunk:
+            f.write(memoryview(chunk._data)[:chunk._position])
+
+    @locked(write=True)
+    def load_snapshot(self, f):
+        if len(self._register):
+            raise ValueError("Snapshots can only be loaded into an empty store")
+        magic, version, size = Snapshot.header.unpack(f.read(Snapshot.header.size))
+        if magic != Snapshot.magic or version != Snapshot.version:
+            raise ValueError("Not an aboutdb snapshot")
+        chunks = PointerTable(None).load(f.read(size), self._register)
+        self._chunk.restore(chunks, f)
+        self._doc_cache.clear()
+        self._value_cache.clear()
+        self._reindex()
+        self.flush()
+
+    @locked(write=True)
+    def compact(self, budget=100):
+        return self._compactor.step(budget)
+
+    def _commit(self):
+        if self._wal is not None:
+            self._wal.commit()
+
+    def _discard(self, identity, field):
+        pointer = self._register.pointer(identity, field)
+        if pointer is not None:
+            self._chunk.discard(pointer)
+            if isinstance(pointer, Pointer):
+                self._value_cache.pop((pointer.chunk, pointer.position))
+
+    @locked(write=False)
+    @timed('lookup')
+    def lookup(self, schema, field, value):
+        if TRACE:
+            log.debug("Lookup %s::%s = %s", schema, field, value)
+        index = self._index_for(schema, field)
+        if index is not None:
+            return self._detach(index.lookup(self._index_db_conn, value))
+
+    @locked(write=False)
+    @timed('lookup_range')
+    def lookup_range(self, schema, field, startkey=None, endkey=None, limit=None, descending=False):
+        if TRACE:
+            log.debug("Lookup %s::%s from %s to %s", schema, field, startkey, endkey)
+        index = self._index_for(schema, field)
+        if index is not None:
+            return self._detach(index.lookup_range(self._index_db_conn, startkey=startkey, endkey=endkey,
+                                                   limit=limit, descending=descending))
+
+    @locked(write=False)
+    @timed('query')
+    def query(self, schema, where=None, limit=None):
+        if TRACE:
+            log.debug("Query %s where %r", schema, where)
+        identities = self._evaluate(schema, where or {})
+        if limit is not None:
+            identities = itertools.islice(identities, limit)
+        return self._detach(identities)
+
+    @locked(write=False)
+    def explain(self, schema, where=None):
+        return [[(step, predicate.field, estimate) for step, _, predicate, estimate in plan]
+                for plan in self._plans(schema, where or {})]
+
+    def _branches(self, where, conditions=()):
+        conditions = list(conditions) + [(field, condition) for field, condition in where.items() if field != '$or']
+        if '$or' not in where:
+            return [conditions]
+        return [branch for alternative in where['$or'] for branch in self._branches(alternative, conditions)]
+
+    def _plans(self, schema, where):
+        return [self._plan(schema, branch) for branch in self._branches(where)]
+
+    def _plan(self, schema, conditions):
+        predicates = [Predicate.parse(field, condition) for field, condition in conditions]
+        if schema is not None:
+            predicates.append(Predicate('*schema', values=[schema]))
+        indexed = []
+        residual = []
+        for predicate in predicates:
+            index = next((index for index in self._indexes_for(schema, predicate.field)
+                          if index.kind == 'value' and index.fn is None), None)
+            if index is None:
+                residual.append(('residual', None, predicate, None))
+                continue
+            predicate = predicate.coerce(index.field_type)
+            indexed.append((index.estimate(self._index_db_conn, predicate), index, predicate))
+        indexed.sort(key=lambda entry: entry[0])
+        plan = []
+        size = None
+        for estimate, index, predicate in indexed:
+            if size is None:
+                step = 'scan'
+            elif estimate > 8 * size:
+                step = 'probe'
+            else:
+                step = 'merge'
+            plan.append((step, index, predicate, estimate))
+            size = estimate if size is None else min(size, estimate)
+        return plan + residual
+
+    def _evaluate(self, schema, where):
+        streams = [self._execute(plan) for plan in self._plans(schema, where)]
+        if len(streams) == 1:
+            return streams[0]
+        return (identity for identity, _ in itertools.groupby(heapq.merge(*streams)))
+
+    def _execute(self, plan):
+        conn = self._index_db_conn
+        stream = None
+        for step, index, predicate, _ in plan:
+            if step == 'scan':
+                stream = index.ids(conn, predicate)
+            elif step == 'merge':
+                stream = self._intersect(stream, index.ids(conn, predicate))
+            elif step == 'probe':
+                stream = self._probe(stream, index, predicate)
+            else:
+                if stream is None:
+                    stream = iter(sorted(self._register.identities()))
+                stream = self._check(stream, predicate)
+        if stream is None:
+            stream = iter(sorted(self._register.identities()))
+        return stream
+
+    def _intersect(self, left, right):
+        current = next(right, _missing)
+        for identity in left:
+            while current is not _missing and current < identity:
+                current = next(right, _missing)
+            if current is _missing:
+                return
+            if current == identity:
+                yield identity
+
+    def _probe(self, stream, index, predicate, size=500):
+        for batch in iter(lambda: list(itertools.islice(stream, size)), []):
+            found = index.filter(self._index_db_conn, batch, predicate)
+            for identity in batch:
+                if identity in found:
+                    yield identity
+
+    def _check(self, stream, predicate):
+        for identity in stream:
+            pointer = self._register.pointer(identity, predicate.field)
+            if isinstance(pointer, Pointer) and predicate.matches(self._unpoint(pointer)):
+                yield identity
+
+    @locked(write=False)
+    @timed('search')
+    def search(self, schema, field, text, kind='token', limit=None, **kwargs):
+        if TRACE:
+            log.debug("Search %s::%s for %r", schema, field, text)
+        index = self._index_for(schema, field, kind=kind)
+        if index is None:
+            return None
+        if kind != 'trigram':
+            return self._detach(index.search(self._index_db_conn, text, limit=limit, **kwargs))
+        needle = str(text).lower()
+        identities = (identity for identity in index.candidates(self._index_db_conn, text)
+                      if self._contains(identity, field, needle))
+        return self._detach(itertools.islice(identities, limit))
+
+    def _contains(self, identity, field, needle):
+        pointer = self._register.pointer(identity, field)
+        if not isinstance(pointer, Pointer):
+            return False
+        value = self._unpoint(pointer)
+        values = value if type(value) is list else [value]
+        return any(needle in str(value).lower() for value in values)
+
+    @locked(write=False)
+    @timed('column')
+    def column(self, schema, field, with_ids=False, numpy=False):
+        members = None if schema is None else set(self._index_for(None, '*schema').lookup(self._index_db_conn, schema))
+        identities = []
+        values = array('q')
+        for identity, pointer in self._register.column(field):
+            if not isinstance(pointer, Pointer) or pointer.type not in (int, float):
+                continue
+            if members is not None and identity not in members:
+                continue
+            data = self._chunk[pointer.chunk]._data
+            position = pointer.position
+            if data[position] == INT:
+                n, _ = _read_varint(data, position + 1)
+                value = (n >> 1) if not n & 1 else -((n + 1) >> 1)
+            else:
+                value = _float.unpack_from(data, position + 1)[0]
+            try:
+                values.append(value)
+            except (TypeError, OverflowError):
+                values = array('d', values)
+                values.append(value)
+            identities.append(identity)
+        if numpy:
+            import numpy
+            values = numpy.frombuffer(values, dtype=numpy.int64 if values.typecode == 'q' else numpy.float64)
+        return (identities, values) if with_ids else values
+
+    def track(self, schema, field):
+        self._aggregates[(schema, field)] = Aggregate(schema, field)
+
+    def _track(self, identity, field, value=_missing):
+        if not self._aggregates:
+            return
+        schema = self._schema_of(identity)
+        if field == '*schema':
+            new_schema = None if value is _missing else value
+            if new_schema == schema:
+                return
+            for (aggregate_schema, aggregate_field), aggregate in self._aggregates.items():
+                if aggregate.stale or aggregate_schema is None or aggregate_schema not in (schema, new_schema):
+                    continue
+                pointer = self._register.pointer(identity, aggregate_field)
+                if not isinstance(pointer, Pointer) or pointer.type not in (int, float):
+                    continue
+                if aggregate_schema == schema:
+                    aggregate.remove(self._unpoint(pointer))
+                else:
+                    aggregate.add(self._unpoint(pointer))
+            return
+        for key in ((schema, field), (None, field)) if schema is not None else ((None, field),):
+            aggregate = self._aggregates.get(key)
+            if aggregate is None or aggregate.stale:
+                continue
+            pointer = self._register.pointer(identity, field)
+            if isinstance(pointer, Pointer) and pointer.type in (int, float):
+                aggregate.remove(self._unpoint(pointer))
+            if type(value) in (int, float):
+                aggregate.add(value)
+
+    @locked(write=False)
+    @timed('aggregate')
+    def aggregate(self, schema, field):
+        aggregate = self._aggregates.get((schema, field))
+        if aggregate is None:
+            aggregate = Aggregate(schema, field)
+        elif not aggregate.stale:
+            return aggregate.result()
+        aggregate.reset(self.column(schema, field))
+        return aggregate.result()
+
+    @locked(write=False)
+    def histogram(self, schema, field, bins=10, bounds=None):
+        values = self.column(schema, field)
+        low, high = bounds if bounds is not None else (min(values, default=0), max(values, default=0))
+        width = (high - low) / bins or 1
+        counts = [0] * bins
+        for value in values:
+            if low <= value <= high:
+                counts[min(int((value - low) / width), bins - 1)] += 1
+        return counts, [low + width * n for n in range(bins + 1)]
+
+    @locked(write=False)
     def get_field_by_id(self, identity, field):
-        logging.debug("Get %s::%s", identity, field)
-        for index in self._index:
-            if index.handles_field(field):
-                return index.get_value_by_id(self._index_db_conn, identity)
+        if TRACE:
+            log.debug("Get %s::%s", identity, field)
+        index = self._index_for(None, field)
+        if index is not None:
+            return index.get_value_by_id(self._index_db_conn, identity)
 
-        pointer = self._objects[identity][field]
+        pointer = self._register.get(identity)[field]
+        if isinstance(pointer, Link):
+            return self.get(pointer.identity)
         return self._unpoint(pointer)
 
     def _unpoint(self, pointer):
-        logging.debug("Unpoint %s", pointer)
+        if TRACE:
+            log.debug("Unpoint %s", pointer)
+        mutable = pointer.type in (list, dict)
+        if not mutable:
+            key = (pointer.chunk, pointer.position)
+            value = self._value_cache.get(key, _missing)
+            if value is not _missing:
+                return value
         chunk = self._chunk[pointer.chunk]
         data = chunk.get(pointer.position, pointer.size)
-        logging.debug(data)
-        return Item.from_bytes(pointer.type, data)
+        value = Item.from_bytes(pointer.type, data)
+        if not mutable:
+            self._value_cache.put(key, value)
+        return value
+
+    def _schema_of(self, identity):
+        pointer = self._register.pointer(identity, '*schema')
+        if not isinstance(pointer, Pointer):
+            return None
+        return self._unpoint(pointer)
+
+    def _item_for(self, identity, field):
+        value = self._unpoint(self._register.pointer(identity, field))
+        if type(value) is list:
+            return List(identity, field, value)
+        return Item(identity, field, value)
+
+    @timed('unindex')
+    def _unindex(self, identity, fields, schema_only=False):
+        if self._deferred is not None:
+            self._deferred.add(identity)
+            return
+        schema = self._schema_of(identity)
+        if schema_only:
+            indexes = [index for field in fields if field != '*schema'
+                       for index in self._index_by_key.get((schema, field), [])]
+            indexes += self._indexes_for(schema, '*schema')
+        else:
+            indexes = [index for field in fields for index in self._indexes_for(schema, field)]
+        if not indexes:
+            return
+        with self._index_db_conn:
+            for index in indexes:
+                index.remove(self._index_db_conn, [identity])
 
     def _run_indexing_on(self, item: Item):
-        schema = self.get_field_by_id(item.identity, '*schema')
-        for index in self._index:
-            if index.handles(schema, item):
-                index.run(self._index_db_conn, item)
+        self._run_indexing_on_many(self._plan_indexing([item]), [item.identity])
+
+    def _plan_indexing(self, items, old_schemas=None):
+        old_schemas = old_schemas or {}
+        schemas = dict(old_schemas)
+        for item in items:
+            if item.field == '*schema':
+                schemas[item.identity] = item.value
+        work = {}
+        removals = {}
+        reindexed = []
+        for identity, old_schema in old_schemas.items():
+            if old_schema == schemas[identity] or identity not in self._register:
+                continue
+            for field, pointer in self._register.get(identity).items():
+                for index in self._index_by_key.get((old_schema, field), []) if old_schema else []:
+                    removals.setdefault(id(index), (index, set()))[1].add(identity)
+                if field != '*schema' and isinstance(pointer, Pointer):
+                    reindexed.append(self._item_for(identity, field))
+        for item in reindexed + list(items):
+            if item.identity not in schemas:
+                schemas[item.identity] = self._schema_of(item.identity)
+            for index in self._indexes_for(schemas[item.identity], item.field):
+                work.setdefault(id(index), (index, {}))[1][item.identity] = item
+        return (list(removals.values()),
+                [(index, list(index_items), [row for item in index_items.values() for row in index.rows(item)])
+                 for index, index_items in work.values()])
+
+    @timed('index')
+    def _run_indexing_on_many(self, plan, identities):
+        if self._deferred is not None:
+            self._deferred.update(identities)
+            return
+        removals, work = plan
+        if not work and not removals:
+            return
+        with self._index_db_conn:
+            for index, removed in removals:
+                index.remove(self._index_db_conn, removed)
+            for index, indexed, rows in work:
+                index.remove(self._index_db_conn, indexed)
+                index.insert(self._index_db_conn, rows)
+
+
+class AsyncAboutDB:
+    def __init__(self, db=None, readers=4, page_size=256, **kwargs):
+        self.db = db if db is not None else AboutDB(concurrent=True, **kwargs)
+        if not self.db.concurrent:
+            raise ValueError("AsyncAboutDB needs an AboutDB created with concurrent=True")
+        self.page_size = page_size
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='aboutdb-writer')
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='aboutdb-reader')
+        self._pending = []
+        self._flush_scheduled = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self._write(self.db.close)
+        self._writer.shutdown()
+        self._readers.shutdown()
+
+    def _read(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._readers, functools.partial(fn, *args, **kwargs))
+
+    def _write(self, fn, *args, **kwargs):
+        self._flush()
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._writer, functools.partial(fn, *args, **kwargs))
+
+    def set(self, identity: str, field: str, value):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        try:
+            encode(value)
+        except TypeError as e:
+            future.set_exception(e)
+            return future
+        self._pending.append((identity, field, value, future))
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            loop.call_soon(self._flush)
+        return future
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        loop = asyncio.get_running_loop()
+        done = loop.run_in_executor(self._writer, self.db.set_many,
+                                    [(identity, field, value) for identity, field, value, _ in pending])
+
+        def resolve(done):
+            error = done.exception()
+            for *_, future in pending:
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+
+        done.add_done_callback(resolve)
+
+    def unset(self, identity: str, field: str):
+        return self._write(self.db.unset, identity, field)
+
+    def link(self, identity: str, field: str, target_identity: str):
+        return self._write(self.db.link, identity, field, target_identity)
+
+    def delete(self, identity):
+        return self._write(self.db.delete, identity)
+
+    def index(self, schema, name, **kwargs):
+        return self._write(self.db.index, schema, name, **kwargs)
+
+    def define(self, name, map_fn, reduce_fn=None):
+        return self._write(self.db.define, name, map_fn, reduce_fn)
+
+    def get(self, identity, **kwargs):
+        return self._read(self.db.get, identity, **kwargs)
+
+    def get_many(self, identities, **kwargs):
+        return self._read(self.db.get_many, identities, **kwargs)
+
+    @staticmethod
+    def _materialize(fn, *args, **kwargs):
+        rows = fn(*args, **kwargs)
+        return None if rows is None else list(rows)
+
+    async def _stream(self, fn, *args, **kwargs):
+        rows = await self._read(self._materialize, fn, *args, **kwargs)
+        if rows is None:
+            return
+        for start in range(0, len(rows), self.page_size):
+            for row in rows[start:start+self.page_size]:
+                yield row
+            await asyncio.sleep(0)
+
+    def lookup(self, schema, field, value):
+        return self._stream(self.db.lookup, schema, field, value)
+
+    def lookup_range(self, schema, field, **kwargs):
+        return self._stream(self.db.lookup_range, schema, field, **kwargs)
+
+    def view(self, name, **kwargs):
+        return self._stream(self.db.view, name, **kwargs)
+
+
+def _shard_worker(conn, kwargs):
+    db = AboutDB(**kwargs)
+    try:
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                break
+            if request is None:
+                break
+            method, args, kwargs = request
+            try:
+                result = getattr(db, method)(*args, **kwargs)
+                if result is not None and hasattr(result, '__next__'):
+                    result = list(result)
+            except Exception as e:
+                reply = (False, e)
+            else:
+                reply = (True, result)
+            try:
+                conn.send(reply)
+            except Exception as e:
+                conn.send((False, RuntimeError("Cannot return result of %s: %s" % (method, e))))
+    finally:
+        db.close()
+        conn.close()
+
+
+class ShardedAboutDB:
+    def __init__(self, shards=4, path=None, **kwargs):
+        if shards < 1:
+            raise ValueError("Need at least one shard")
+        self.shards = shards
+        self.path = path
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            existing = [name for name in os.listdir(path) if name.startswith('shard-')]
+            if existing and len(existing) != shards:
+                raise ValueError("%s holds %d shards, not %d" % (path, len(existing), shards))
+        self._pipe_locks = [threading.Lock() for _ in range(shards)]
+        self._local = threading.local()
+        self._reducers = {}
+        self._conns = []
+        self._processes = []
+        for n in range(shards):
+            shard_kwargs = dict(kwargs)
+            if path is not None:
+                shard_kwargs['path'] = os.path.join(path, 'shard-%03d' % n)
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_shard_worker, args=(child, shard_kwargs),
+                                              name='aboutdb-shard-%d' % n, daemon=True)
+            process.start()
+            child.close()
+            self._conns.append(parent)
+            self._processes.append(process)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def shard_of(self, identity):
+        return zlib.crc32(identity.encode('utf-8')) % self.shards
+
+    def _call(self, shard, method, *args, **kwargs):
+        return self._call_many([(shard, method, args, kwargs)])[0]
+
+    @contextmanager
+    def _pipes(self, shards):
+        locks = [self._pipe_locks[shard] for shard in sorted(set(shards))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def _call_many(self, calls):
+        payloads = [multiprocessing.reduction.ForkingPickler.dumps((method, args, kwargs))
+                    for _, method, args, kwargs in calls]
+        replies = []
+        with self._pipes(shard for shard, _, _, _ in calls):
+            sent = []
+            try:
+                for (shard, _, _, _), payload in zip(calls, payloads):
+                    self._conns[shard].send_bytes(payload)
+                    sent.append(shard)
+            finally:
+                replies = [self._conns[shard].recv() for shard in sent]
+        for ok, result in replies:
+            if not ok:
+                raise result
+        return [result for _, result in replies]
+
+    def _broadcast(self, method, *args, **kwargs):
+        return self._call_many([(shard, method, args, kwargs) for shard in range(self.shards)])
+
+    def close(self):
+        if not self._conns:
+            return
+        self._broadcast('flush')
+        with self._pipes(range(self.shards)):
+            for conn in self._conns:
+                conn.send(None)
+                conn.close()
+            self._conns = []
+        for process in self._processes:
+            process.join()
+
+    def flush(self):
+        self._broadcast('flush')
+
+    checkpoint = flush
+
+    def compact(self, budget=100):
+        return any(self._broadcast('compact', budget))
+
+    def stats(self):
+        return self._broadcast('stats')
+
+    def index(self, schema, name, field=None, fn=None, field_type=str, backend='sqlite', kind='value'):
+        self._broadcast('index', schema, name, field=field, fn=fn, field_type=field_type,
+                        backend=backend, kind=kind)
+
+    def define(self, name, map_fn, reduce_fn=None):
+        self._broadcast('define', name, map_fn, reduce_fn)
+        self._reducers[name] = reduce_fn
+
+    @property
+    def _batch(self):
+        return getattr(self._local, 'batch', None)
+
+    @_batch.setter
+    def _batch(self, items):
+        self._local.batch = items
+
+    def set(self, identity: str, field: str, value):
+        if self._batch is not None:
+            self._batch.append((identity, field, value))
+        else:
+            self._call(self.shard_of(identity), 'set', identity, field, value)
+
+    def set_many(self, items):
+        work = {}
+        for identity, field, value in items:
+            work.setdefault(self.shard_of(identity), []).append((identity, field, value))
+        self._call_many([(shard, 'set_many', (shard_items,), {}) for shard, shard_items in work.items()])
+
+    @contextmanager
+    def batch(self):
+        if self._batch is not None:
+            yield self
+            return
+        self._batch = []
+        try:
+            yield self
+            items = self._batch
+        finally:
+            self._batch = None
+        self.set_many(items)
+
+    def _drain(self):
+        if self._batch:
+            items, self._batch = self._batch, []
+            self.set_many(items)
+
+    def unset(self, identity: str, field: str):
+        self._drain()
+        self._call(self.shard_of(identity), 'unset', identity, field)
+
+    def link(self, identity: str, field: str, target_identity: str):
+        self._drain()
+        self._call(self.shard_of(identity), 'link', identity, field, target_identity)
+
+    def delete(self, identity):
+        self._drain()
+        self._call(self.shard_of(identity), 'delete', identity)
+
+    def get(self, identity, depth=None, fields=None):
+        return self._resolve([identity], depth=depth, fields=fields)[0]
+
+    def get_many(self, identities, fields=None, depth=None):
+        return self._resolve(list(identities), depth=depth, fields=fields)
+
+    def _fetch(self, identities, loaded):
+        work = {}
+        for identity in identities:
+            if identity not in loaded:
+                work.setdefault(self.shard_of(identity), []).append(identity)
+        shards = list(work)
+        replies = self._call_many([(shard, '_raw_many', (work[shard],), {}) for shard in shards])
+        for shard, objects in zip(shards, replies):
+            loaded.update(zip(work[shard], objects))
+
+    def _resolve(self, identities, depth=None, fields=None):
+        loaded = {}
+        roots = [{} for _ in identities]
+        frontier = [(root, identity, frozenset((identity,)), 0) for root, identity in zip(roots, identities)]
+        while frontier:
+            self._fetch([current for _, current, _, _ in frontier], loaded)
+            following = []
+            for result, current, path, level in frontier:
+                obj = loaded[current]
+                if obj is None:
+                    raise KeyError(current)
+                if level == 0 and fields is not None:
+                    obj = {field: obj[field] for field in fields if field in obj}
+                for field, value in obj.items():
+                    if isinstance(value, Link):
+                        target = value.identity
+                        if target in path or (depth is not None and level >= depth):
+                            result[field] = {'_id': target}
+                        else:
+                            result[field] = {}
+                            following.append((result[field], target, path | {target}, level + 1))
+                    else:
+                        result[field] = value
+                result['_id'] = current
+            frontier = following
+        return roots
+
+    def lookup(self, schema, field, value):
+        results = self._broadcast('lookup', schema, field, value)
+        if all(ids is None for ids in results):
+            return None
+        return iter([identity for ids in results if ids for identity in ids])
+
+    def lookup_range(self, schema, field, startkey=None, endkey=None, limit=None, descending=False):
+        results = self._broadcast('lookup_range', schema, field, startkey=startkey, endkey=endkey,
+                                  limit=limit, descending=descending)
+        if all(rows is None for rows in results):
+            return None
+        rows = heapq.merge(*(rows for rows in results if rows), reverse=descending)
+        return iter(list(itertools.islice(rows, limit)))
+
+    def track(self, schema, field):
+        self._broadcast('track', schema, field)
+
+    def column(self, schema, field):
+        values = array('q')
+        for column in self._broadcast('column', schema, field):
+            if column.typecode != values.typecode:
+                values = array('d', values)
+            values.extend(column)
+        return values
+
+    def aggregate(self, schema, field):
+        results = [result for result in self._broadcast('aggregate', schema, field) if result['count']]
+        return {'count': sum(result['count'] for result in results),
+                'sum': sum(result['sum'] for result in results),
+                'min': min((result['min'] for result in results), default=None),
+                'max': max((result['max'] for result in results), default=None)}
+
+    def query(self, schema, where=None, limit=None):
+        results = self._broadcast('query', schema, where, limit=limit)
+        return iter(list(itertools.islice(heapq.merge(*results), limit)))
+
+    def view(self, name, key=None, startkey=None, endkey=None, include_docs=False,
+             group=False, reduce=True, skip=0, limit=None, descending=False):
+        reduce_fn = self._reducers.get(name)
+        reduced = reduce_fn is not None and reduce
+        shard_limit = None if limit is None or reduced else (skip or 0) + limit
+        results = self._broadcast('view', name, key=key, startkey=startkey, endkey=endkey,
+                                  group=group, reduce=reduce, limit=shard_limit, descending=descending)
+        if reduced and not group:
+            values = [rows[0]['value'] for rows in results if rows]
+            rows = iter([{'key': None, 'value': self._rereduce(reduce_fn, values)}])
+        else:
+            rows = heapq.merge(*results, key=lambda row: (collate(row['key']), row.get('id', '')),
+                               reverse=descending)
+            if reduced:
+                rows = self._regroup(reduce_fn, rows)
+            rows = itertools.islice(rows, skip or 0, None if limit is None else (skip or 0) + limit)
+        rows = list(rows)
+        if include_docs:
+            docs = self.get_many([row['id'] for row in rows if 'id' in row])
+            for row, doc in zip((row for row in rows if 'id' in row), docs):
+                row['doc'] = doc
+        return iter(rows)
+
+    def _rereduce(self, reduce_fn, values):
+        if len(values) == 1:
+            return values[0]
+        return reduce_fn(None, values, True)
+
+    def _regroup(self, reduce_fn, rows):
+        for _, group in itertools.groupby(rows, key=lambda row: collate(row['key'])):
+            group = list(group)
+            yield {'key': group[0]['key'], 'value': self._rereduce(reduce_fn, [row['value'] for row in group])}
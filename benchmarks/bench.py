@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from aboutdb import AboutDB  # noqa: E402
+
+
+SIZES = {
+    '10k': 10000,
+    '1M': 1000000,
+    '10M': 10000000,
+}
+
+FIELDS_PER_OBJECT = 5
+SCHEMA = 'Entry'
+
+
+def peak_rss():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform != 'darwin' else usage // 1024
+
+
+def objects_for(fields):
+    return max(1, fields // FIELDS_PER_OBJECT)
+
+
+def make_value(n, field):
+    if field == 0:
+        return n
+    elif field == 1:
+        return 'name-%d' % n
+    elif field == 2:
+        return n * 0.5
+    elif field == 3:
+        return n % 100
+    return 'category-%d' % (n % 17)
+
+
+def populate(db, count):
+    with db.batch():
+        for n in range(count):
+            identity = 'O%d' % n
+            db.set(identity, '*schema', SCHEMA)
+            for field in range(FIELDS_PER_OBJECT - 1):
+                db.set(identity, 'f%d' % field, make_value(n, field))
+
+
+class Bench:
+    def __init__(self, name, ops):
+        self.name = name
+        self.ops = ops
+        self.latencies = []
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+
+    def measure(self, fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+    def result(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(fraction):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+        return {
+            'name': self.name,
+            'ops': self.ops,
+            'seconds': self.elapsed,
+            'ops_per_sec': self.ops / self.elapsed if self.elapsed else None,
+            'p50': percentile(0.5),
+            'p99': percentile(0.99),
+            'peak_rss_kb': peak_rss(),
+        }
+
+
+def bench_set(fields, sample):
+    db = AboutDB()
+    with Bench('set', fields) as bench:
+        for n in range(objects_for(fields)):
+            identity = 'O%d' % n
+            bench.measure(db.set, identity, '*schema', SCHEMA)
+            for field in range(FIELDS_PER_OBJECT - 1):
+                bench.measure(db.set, identity, 'f%d' % field, make_value(n, field))
+    return bench.result()
+
+
+def bench_bulk_load(fields, sample):
+    db = AboutDB()
+    db.index(SCHEMA, 'f3', field_type=int)
+    with Bench('bulk_load', fields) as bench:
+        bench.measure(populate, db, objects_for(fields))
+    return bench.result()
+
+
+def bench_get(fields, sample):
+    db = AboutDB()
+    count = objects_for(fields)
+    populate(db, count)
+    keys = ['O%d' % random.randrange(count) for _ in range(sample)]
+    with Bench('get', sample) as bench:
+        for identity in keys:
+            bench.measure(db.get, identity)
+    return bench.result()
+
+
+def bench_link_get(fields, sample):
+    db = AboutDB()
+    count = objects_for(fields)
+    populate(db, count)
+    for n in range(1, count):
+        db.link('O%d' % n, 'parent', 'O%d' % (n // 2))
+    keys = ['O%d' % random.randrange(count) for _ in range(sample)]
+    with Bench('link_get', sample) as bench:
+        for identity in keys:
+            bench.measure(db.get, identity)
+    return bench.result()
+
+
+def bench_lookup(fields, sample, backend='sqlite', name='lookup'):
+    db = AboutDB()
+    db.index(SCHEMA, 'f3', field_type=int, backend=backend)
+    populate(db, objects_for(fields))
+    with Bench(name, sample) as bench:
+        for n in range(sample):
+            bench.measure(lambda value: list(db.lookup(SCHEMA, 'f3', value)), n % 100)
+    return bench.result()
+
+
+def bench_memory_lookup(fields, sample):
+    return bench_lookup(fields, sample, backend='memory', name='memory_lookup')
+
+
+def bench_index_maintenance(fields, sample):
+    db = AboutDB()
+    db.index(SCHEMA, 'f3', field_type=int)
+    count = objects_for(fields)
+    populate(db, count)
+    with Bench('index_maintenance', sample) as bench:
+        for n in range(sample):
+            bench.measure(db.set, 'O%d' % random.randrange(count), 'f3', n % 100)
+    return bench.result()
+
+
+BENCHMARKS = {
+    'set': bench_set,
+    'bulk_load': bench_bulk_load,
+    'get': bench_get,
+    'link_get': bench_link_get,
+    'lookup': bench_lookup,
+    'memory_lookup': bench_memory_lookup,
+    'index_maintenance': bench_index_maintenance,
+}
+
+
+def run_isolated(name, args):
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', name, '--size', args.size,
+         '--sample', str(args.sample), '--seed', str(args.seed)],
+        check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark core aboutdb operations')
+    parser.add_argument('--size', choices=sorted(SIZES), default='10k',
+                        help='number of fields to load (default: 10k)')
+    parser.add_argument('--sample', type=int, default=10000,
+                        help='number of reads/lookups/updates to time (default: 10000)')
+    parser.add_argument('--only', action='append', choices=sorted(BENCHMARKS),
+                        help='run only the given benchmark (repeatable)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='compare throughput against an earlier JSON result file')
+    parser.add_argument('--child', choices=sorted(BENCHMARKS), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    fields = SIZES[args.size]
+    if args.child:
+        random.seed(args.seed)
+        json.dump(BENCHMARKS[args.child](fields, args.sample), sys.stdout)
+        return
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {result['name']: result for result in json.load(f)['results']}
+
+    results = []
+    for name in args.only or BENCHMARKS:
+        result = run_isolated(name, args)
+        result['fields'] = fields
+        results.append(result)
+        print('%-18s %10.0f ops/s  p50 %8.1f us  p99 %8.1f us  rss %d kB' % (
+            name, result['ops_per_sec'] or 0, (result['p50'] or 0) * 1e6,
+            (result['p99'] or 0) * 1e6, result['peak_rss_kb']))
+        if name in baseline and baseline[name]['ops_per_sec']:
+            print('%-18s %+9.1f%% vs baseline' % (
+                '', 100.0 * (result['ops_per_sec'] / baseline[name]['ops_per_sec'] - 1)))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'size': args.size,
+                'sample': args.sample,
+                'seed': args.seed,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'results': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
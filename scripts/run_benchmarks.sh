@@ -0,0 +1,6 @@
+#!/bin/bash -e
+# Usage
+#   $ ./scripts/run_benchmarks.sh
+# or
+#   $ ./scripts/run_benchmarks.sh --size 1M --output bench-1M.json
+python benchmarks/bench.py $@
@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 
+import asyncio
+import io
+import json
+import os
+import pickle
 import pytest
-from aboutdb import AboutDB
+import threading
+from aboutdb import AboutDB, AsyncAboutDB, ShardedAboutDB, WriteAheadLog
 from pprint import pprint as pp
 from .fixtures import *
 
@@ -91,3 +97,769 @@ def test_unlink(db: AboutDB, a, b):
     db.unset(a[ID], 'b')
     a = db.get(a[ID])
     assert 'b' not in a.keys()
+
+
+def test_chunk_rollover():
+    db = AboutDB(chunk_size=16)
+    for n in range(10):
+        db.set('A', 'f%d' % n, 'value-%d' % n)
+    assert len(db._chunk) > 1
+    a = db.get('A')
+    for n in range(10):
+        assert a['f%d' % n] == 'value-%d' % n
+
+
+def test_chunk_larger_than_chunk_size():
+    db = AboutDB(chunk_size=4)
+    db.set('A', 's', 'this is longer than four bytes')
+    assert db.get('A')['s'] == 'this is longer than four bytes'
+
+
+def test_chunk_growth():
+    db = AboutDB(chunk_size=8, chunk_growth=2.0, max_chunk_size=32)
+    for n in range(20):
+        db.set('A', 'f%d' % n, 'abcdef')
+    sizes = [chunk.size for chunk in db._chunk]
+    assert sizes[:3] == [8, 16, 32]
+    assert max(sizes) == 32
+
+
+def test_dead_bytes_tracked(db: AboutDB):
+    db.set('A', 's', 'abcd')
+    size = db._register.pointer('A', 's').size
+    db.set('A', 's', 'efgh')
+    assert db._chunk.active.dead == size
+    db.unset('A', 's')
+    assert db._chunk.active.dead == 2 * size
+
+
+def test_compact():
+    db = AboutDB(chunk_size=16)
+    for n in range(20):
+        db.set('A', 'a', 'value-%02d' % n)
+        db.set('B', 'b', 'b-%02d' % n)
+    chunks_before = sum(1 for chunk in db._chunk if chunk.size)
+    while db.compact(budget=1):
+        pass
+    assert sum(1 for chunk in db._chunk if chunk.size) < chunks_before
+    assert db.get('A')['a'] == 'value-19'
+    assert db.get('B')['b'] == 'b-19'
+    assert all(chunk.dead == 0 for chunk in db._chunk if chunk is not db._chunk.active)
+
+
+@pytest.mark.parametrize('checkpoint', [False, True])
+def test_compact_reuses_released_chunks(tmp_path, checkpoint):
+    path = str(tmp_path / 'store')
+    with AboutDB(path=path, chunk_size=1024) as db:
+        for round in range(40):
+            for n in range(50):
+                db.set('O%d' % n, 'v', 'x' * 40 + '%02d' % round)
+            while db.compact():
+                pass
+            if checkpoint:
+                db.flush()
+        assert len(db._chunk) < 10
+        files = [name for name in os.listdir(path) if name.startswith('chunk-')]
+        assert len(files) == sum(1 for chunk in db._chunk if chunk.size or chunk.reclaim)
+    with AboutDB(path=path, chunk_size=1024) as db:
+        assert all(db.get('O%d' % n)['v'].endswith('39') for n in range(50))
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_compact_visits_only_chunk_members(compact):
+    db = AboutDB(chunk_size=64, compact_register=compact)
+    for n in range(200):
+        db.set('O%d' % n, 'a', 'value-%d' % n)
+    db.set('O0', 'a', 'rewritten')
+    db.link('O1', 'a', 'O2')
+    db.delete('O2')
+    db.delete('O3')
+    assert db._register.members(0) == ['O4', 'O5', 'O6']
+    while db.compact(budget=1):
+        pass
+    assert db._compactor.moved == 3
+    assert db._register.members(0) == []
+    assert db.get('O5')['a'] == 'value-5'
+
+
+def test_compact_nothing_to_do(db: AboutDB, a):
+    assert db.compact() is False
+
+
+def test_file_backed_reopen(tmp_path):
+    path = str(tmp_path / 'store')
+    with AboutDB(path=path, chunk_size=32) as db:
+        db.set('A', 'a', 1)
+        db.set('A', 's', 'a string that spans chunks')
+        db.set('B', 'a', 2)
+        db.link('A', 'b', 'B')
+
+    with AboutDB(path=path, chunk_size=32) as db:
+        a = db.get('A')
+        assert a['a'] == 1
+        assert a['s'] == 'a string that spans chunks'
+        assert a['b'][ID] == 'B'
+        assert a['b']['a'] == 2
+        db.set('B', 'a', 3)
+
+    with AboutDB(path=path, chunk_size=32) as db:
+        assert db.get('B')['a'] == 3
+
+
+def test_compact_register():
+    db = AboutDB(compact_register=True)
+    db.set('A', 'a', 1)
+    db.set('A', 's', 'string')
+    db.set('B', 'a', 2)
+    db.link('A', 'b', 'B')
+    db.set('A', 'a', 3)
+    a = db.get('A')
+    assert a['a'] == 3
+    assert a['s'] == 'string'
+    assert a['b']['a'] == 2
+    db.unset('A', 's')
+    assert 's' not in db.get('A')
+    db.delete('B')
+    with pytest.raises(KeyError):
+        db.get('B')
+
+
+def test_compact_register_memory():
+    plain, compact = AboutDB(), AboutDB(compact_register=True)
+    for n in range(1000):
+        for store in (plain, compact):
+            store.set('O%d' % n, 'a', n)
+            store.set('O%d' % n, 'b', n)
+    plain_usage = plain._register.memory_usage()
+    compact_usage = compact._register.memory_usage()
+    assert plain_usage['entries'] == compact_usage['entries'] == 2000
+    assert compact_usage['per_entry'] < plain_usage['per_entry']
+
+
+def test_set_many(db: AboutDB):
+    db.set_many([('A', 'a', 1), ('A', 's', 'x'), ('B', 'a', 2)])
+    assert db.get('A')['a'] == 1
+    assert db.get('A')['s'] == 'x'
+    assert db.get('B')['a'] == 2
+
+
+def test_batch_is_applied_on_exit(db: AboutDB):
+    with db.batch():
+        db.set('A', 'a', 1)
+        with pytest.raises(KeyError):
+            db.get('A')
+    assert db.get('A')['a'] == 1
+
+
+def test_batch_keeps_write_order(db: AboutDB):
+    db.set('A', 'a', 0)
+    with db.batch():
+        db.set('A', 'a', 1)
+        db.unset('A', 'a')
+        db.set('B', 'b', 1)
+        db.link('B', 'b', 'A')
+        db.set('C', 'c', 1)
+        db.delete('C')
+    assert 'a' not in db.get('A')
+    assert db.get('B')['b'] == {'_id': 'A'}
+    with pytest.raises(KeyError):
+        db.get('C')
+
+
+def test_batch_discarded_on_error(db: AboutDB):
+    with pytest.raises(RuntimeError):
+        with db.batch():
+            db.set('A', 'a', 1)
+            raise RuntimeError
+    with pytest.raises(KeyError):
+        db.get('A')
+
+
+@pytest.mark.parametrize('value', [
+    0, -1, 2 ** 40, -(2 ** 70), 1.5, True, False, None, b'\x00\xff', '', 'åäö',
+    [1, 'two', [3.0]], {'a': 1, 'b': [None, {'c': b'd'}]},
+])
+def test_value_types(db: AboutDB, value):
+    db.set('A', 'v', value)
+    assert db.get('A')['v'] == value
+    assert type(db.get('A')['v']) is type(value)
+
+
+def test_encodable_types_are_stored_as_decoded_type(tmp_path):
+    path = str(tmp_path / 'store')
+    with AboutDB(path=path, compact_register=True) as db:
+        db.set('A', 't', (1, 2))
+        db.set('A', 'ba', bytearray(b'xy'))
+        db.set('A', 'mv', memoryview(b'z'))
+    with AboutDB(path=path, compact_register=True) as db:
+        a = db.get('A')
+        assert (a['t'], a['ba'], a['mv']) == ([1, 2], b'xy', b'z')
+
+
+def test_unhashable_dict_keys_rejected(db: AboutDB):
+    with pytest.raises(TypeError):
+        db.set('A', 'd', {(1, 2): 3})
+    with pytest.raises(TypeError):
+        db.set('A', 'd', [{'ok': {(1,): 2}}])
+    db.set('A', 'd', {1: 'a', None: 'b', b'k': 'c', 'nested': {2.5: True}})
+    assert db.get('A')['d'] == {1: 'a', None: 'b', b'k': 'c', 'nested': {2.5: True}}
+
+
+def test_small_ints_are_compact(db: AboutDB):
+    db.set('A', 'a', 5)
+    assert db._register.pointer('A', 'a').size == 2
+
+
+def test_cache_hits_and_invalidation(db: AboutDB, a):
+    db.get('A')
+    before = db.cache_stats()['documents']['hits']
+    db.get('A')
+    assert db.cache_stats()['documents']['hits'] == before + 1
+    db.set('A', 'a', 5)
+    assert db.get('A')['a'] == 5
+    db.unset('A', 'a')
+    assert 'a' not in db.get('A')
+
+
+def test_cache_follows_link_target_changes(db: AboutDB, a, b):
+    db.link('A', 'b', 'B')
+    assert db.get('A')['b']['a'] == 2
+    db.set('B', 'a', 7)
+    assert db.get('A')['b']['a'] == 7
+
+
+def test_cache_does_not_share_mutable_values(db: AboutDB):
+    db.set('A', 'l', [1, 2])
+    db.get('A')['l'].append(3)
+    assert db.get('A')['l'] == [1, 2]
+
+
+def test_cache_eviction():
+    db = AboutDB(cache_size=2)
+    for n in range(5):
+        db.set('O%d' % n, 'a', n)
+        db.get('O%d' % n)
+    assert db.cache_stats()['documents']['size'] == 2
+
+
+def test_cache_survives_compaction():
+    db = AboutDB(chunk_size=16)
+    for n in range(20):
+        db.set('A', 'a', 'value-%02d' % n)
+        db.set('B', 'l', ['b', n])
+        db.get('A'), db.get('B')
+    while db.compact(budget=1):
+        pass
+    assert db.get('A')['a'] == 'value-19'
+    assert db.get('B')['l'] == ['b', 19]
+
+
+def test_link_cycle_returns_stub(db: AboutDB, a, b):
+    db.link('A', 'b', 'B')
+    db.link('B', 'back', 'A')
+    a = db.get('A')
+    assert a['b']['a'] == 2
+    assert a['b']['back'] == {ID: 'A'}
+
+
+def test_link_self_reference(db: AboutDB, a):
+    db.link('A', 'self', 'A')
+    assert db.get('A')['self'] == {ID: 'A'}
+
+
+def test_link_depth(db: AboutDB):
+    for n in range(5):
+        db.set('O%d' % n, 'n', n)
+    for n in range(4):
+        db.link('O%d' % n, 'next', 'O%d' % (n + 1))
+    o = db.get('O0', depth=2)
+    assert o['next']['next']['n'] == 2
+    assert o['next']['next']['next'] == {ID: 'O3'}
+    assert db.get('O0', depth=0)['next'] == {ID: 'O1'}
+    assert db.get('O0')['next']['next']['next']['next']['n'] == 4
+
+
+def test_link_deep_chain(db: AboutDB):
+    for n in range(3000):
+        db.link('O%d' % n, 'next', 'O%d' % (n + 1))
+    db.set('O3000', 'n', 'end')
+    o = db.get('O0', depth=None)
+    for _ in range(3000):
+        o = o['next']
+    assert o['n'] == 'end'
+
+
+def test_link_shared_target(db: AboutDB, a):
+    db.set('P', 'x', 'parent')
+    db.link('A', 'p1', 'P')
+    db.link('A', 'p2', 'P')
+    a = db.get('A')
+    assert a['p1'] == a['p2'] == {'x': 'parent', ID: 'P'}
+
+
+def test_get_projection(db: AboutDB, a, b):
+    db.set('A', 's', 'string')
+    db.link('A', 'b', 'B')
+    assert db.get('A', fields=['s']) == {'s': 'string', ID: 'A'}
+    assert db.get('A', fields=['b', 'missing']) == {'b': {'a': 2, ID: 'B'}, ID: 'A'}
+
+
+def test_get_many(db: AboutDB):
+    with db.batch():
+        for n in range(10):
+            db.set('O%d' % n, 'a', n)
+            db.set('O%d' % n, 'b', 'b%d' % n)
+            db.set('O%d' % n, 'c', [n])
+    db.link('O1', 'parent', 'O0')
+    r = db.get_many(['O3', 'O1', 'O2'], fields=['a', 'parent'])
+    assert r == [{'a': 3, ID: 'O3'},
+                 {'a': 1, 'parent': db.get('O0'), ID: 'O1'},
+                 {'a': 2, ID: 'O2'}]
+    assert db.get_many(['O4'])[0] == db.get('O4')
+
+
+def test_get_many_missing(db: AboutDB, a):
+    with pytest.raises(KeyError):
+        db.get_many(['A', 'missing'])
+
+
+def test_get_field_by_id(db: AboutDB, a):
+    assert db.get_field_by_id('A', 'a') == 1
+
+
+def test_get_does_not_print(db: AboutDB, a, capsys):
+    db.get('A')
+    assert capsys.readouterr().out == ''
+
+
+def test_stats(db: AboutDB, a):
+    db.get('A')
+    db.get('A')
+    stats = db.stats()
+    assert stats['operations']['set']['count'] == 1
+    assert stats['operations']['get']['count'] == 3
+    assert stats['operations']['get']['p50'] is not None
+    assert stats['chunks'][0]['written'] > 0
+    assert stats['sqlite_seconds'] == stats['operations']['sqlite']['total'] > 0
+
+
+def test_hooks(db: AboutDB):
+    seen = []
+    db.add_hook(lambda op, seconds: seen.append(op))
+    db.set('A', 'a', 1)
+    assert 'set' in seen
+
+
+def test_concurrent_writers_and_readers():
+    db = AboutDB(concurrent=True, chunk_size=256)
+    db.index('Entry', 'n', field_type=int)
+    errors = []
+
+    def writer(worker):
+        try:
+            for n in range(200):
+                identity = 'W%d-%d' % (worker, n)
+                db.set(identity, '*schema', 'Entry')
+                db.set(identity, 'n', n)
+                db.get(identity)
+                list(db.lookup('Entry', 'n', n))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(worker,)) for worker in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    for worker in range(4):
+        for n in range(200):
+            assert db.get('W%d-%d' % (worker, n))['n'] == n
+    assert sorted(db.lookup('Entry', 'n', 7)) == ['W%d-7' % worker for worker in range(4)]
+    db.close()
+
+
+def test_async_set_get_lookup():
+    async def run():
+        async with AsyncAboutDB(page_size=2) as db:
+            await db.index('Entry', 'n', field_type=int)
+            writes = []
+            for n in range(10):
+                writes.append(db.set('O%d' % n, '*schema', 'Entry'))
+                writes.append(db.set('O%d' % n, 'n', n % 3))
+            await asyncio.gather(*writes)
+            assert db.db.stats()['operations']['write']['count'] < 20
+            assert (await db.get('O4'))['n'] == 1
+            return sorted([identity async for identity in db.lookup('Entry', 'n', 1)])
+
+    assert asyncio.run(run()) == ['O1', 'O4', 'O7']
+
+
+def test_async_write_ordering():
+    async def run():
+        async with AsyncAboutDB() as db:
+            db.set('A', 'a', 1)
+            await db.unset('A', 'a')
+            return await db.get('A')
+
+    assert asyncio.run(run()) == {ID: 'A'}
+
+
+def test_async_bad_value_fails_only_its_own_write():
+    async def run():
+        async with AsyncAboutDB() as db:
+            good = db.set('A', 'a', 1)
+            bad = db.set('B', 'b', object())
+            await good
+            with pytest.raises(TypeError):
+                await bad
+            return await db.get('A')
+
+    assert asyncio.run(run()) == {'a': 1, ID: 'A'}
+
+
+@pytest.mark.parametrize('durability', ['always', 'interval', 'never'])
+def test_wal_replay_after_crash(tmp_path, durability):
+    path = str(tmp_path / 'store')
+    with AboutDB(path=path, durability=durability) as db:
+        db.set('A', 'a', 1)
+
+    crashed = AboutDB(path=path, durability=durability)
+    crashed.index('Entry', 'n', field_type=int)
+    crashed.set('A', 'a', 2)
+    crashed.set('B', '*schema', 'Entry')
+    crashed.set('B', 'n', 5)
+    crashed.set('C', 'c', 'gone')
+    crashed.link('A', 'b', 'B')
+    crashed.delete('C')
+    crashed._wal.commit()
+
+    with open(path + '/wal.log', 'ab') as f:
+        f.write(b'\x00\x00\x00\x10torn')
+
+    with AboutDB(path=path) as db:
+        db.index('Entry', 'n', field_type=int)
+        a = db.get('A')
+        assert a['a'] == 2
+        assert a['b']['n'] == 5
+        with pytest.raises(KeyError):
+            db.get('C')
+        assert list(db.lookup('Entry', 'n', 5)) == ['B']
+
+
+@pytest.mark.parametrize('concurrent', [False, True])
+def test_index_db_inside_store_with_uri_characters(tmp_path, concurrent):
+    path = str(tmp_path / 'a?b#c%41')
+    with AboutDB(path=path, concurrent=concurrent) as db:
+        db.set('A', 'a', 1)
+    assert os.listdir(str(tmp_path)) == ['a?b#c%41']
+    assert 'index.db' in os.listdir(path)
+
+
+def test_wal_truncated_on_checkpoint(tmp_path):
+    path = str(tmp_path / 'store')
+    with AboutDB(path=path) as db:
+        db.set('A', 'a', 1)
+        assert os.path.getsize(path + '/wal.log') > 0
+        db.checkpoint()
+        assert os.path.getsize(path + '/wal.log') == WriteAheadLog.header.size
+
+
+def test_wal_covered_by_checkpoint_is_skipped(tmp_path):
+    path = str(tmp_path / 'store')
+    crashed = AboutDB(path=path)
+    crashed.set('A', 'a', 1)
+    crashed.set('A', 'b', 2)
+    crashed.checkpoint()
+    crashed.unset('A', 'b')
+    crashed.delete('A')
+    crashed.set('B', 'a', 3)
+    crashed._pointer_table.write(crashed._chunk, crashed._register, crashed._pointer_table.generation + 1)
+
+    with AboutDB(path=path) as db:
+        with pytest.raises(KeyError):
+            db.get('A')
+        assert db.get('B')['a'] == 3
+        db.set('C', 'a', 4)
+    with AboutDB(path=path) as db:
+        assert db.get('C')['a'] == 4
+
+
+def test_export_import_ndjson(db: AboutDB, a, b):
+    db.set('A', 'raw', b'\x00\x01')
+    db.set('A', 'l', [1, 'x'])
+    db.link('A', 'b', 'B')
+    buf = io.StringIO()
+    assert db.export_stream(buf) == 2
+
+    other = AboutDB()
+    other.index(None, 'a', field_type=int)
+    buf.seek(0)
+    assert other.import_stream(buf, batch_size=1) == 2
+    assert other.get('A') == db.get('A')
+    assert list(other.lookup(None, 'a', 2)) == ['B']
+
+
+def test_import_from_dicts_and_lines(db: AboutDB):
+    db.import_stream(['{"_id": "A", "a": 1}', {'_id': 'B', 'a': 2, 'p': {'_link': 'A'}}])
+    assert db.get('B')['p'] == {'a': 1, ID: 'A'}
+
+
+def test_export_escapes_marker_dicts_and_import_skips_blank_lines(db: AboutDB):
+    db.set('A', 'meta', {'_link': 'X'})
+    db.set('A', 'raw', [{'_bytes': 'no'}, {'_dict': 1}])
+    buf = io.StringIO()
+    db.export_stream(buf)
+    other = AboutDB()
+    assert other.import_stream(io.StringIO('\n' + buf.getvalue() + '  \n')) == 1
+    assert other.get('A') == db.get('A')
+
+
+def test_export_keeps_non_str_dict_keys(db: AboutDB):
+    db.set('A', 'd', {1: 'a', 2.5: [{None: True}], b'k': {'x': 1}, False: 0})
+    db.set('A', 'e', {'_items': []})
+    buf = io.StringIO()
+    db.export_stream(buf)
+    other = AboutDB()
+    other.import_stream(io.StringIO(buf.getvalue()))
+    assert other.get('A') == db.get('A')
+
+
+def test_export_runs_under_scan_batches():
+    db = AboutDB(concurrent=True, chunk_size=16)
+    for n in range(6):
+        db.set('O%d' % n, 'n', 'value-%d' % n)
+    lines = db._export_lines(batch_size=2)
+    assert json.loads(next(lines)) == {'_id': 'O0', 'n': 'value-0'}
+    db.delete('O3')
+    db.set('O4', 'n', 'changed')
+    while db.compact():
+        pass
+    assert [json.loads(line) for line in lines] == [
+        {'_id': 'O1', 'n': 'value-1'}, {'_id': 'O2', 'n': 'value-2'},
+        {'_id': 'O4', 'n': 'changed'}, {'_id': 'O5', 'n': 'value-5'}]
+
+
+def test_deferred_indexing_is_per_thread():
+    db = AboutDB(concurrent=True)
+    db.index(None, 'a')
+    with db.deferred_indexing():
+        thread = threading.Thread(target=db.set, args=('B', 'a', 'x'))
+        thread.start()
+        thread.join()
+        assert list(db.lookup(None, 'a', 'x')) == ['B']
+
+
+def test_snapshot_roundtrip(db: AboutDB):
+    db.index(None, 'n', field_type=int)
+    db.define('by_n', lambda o: (o['n'], None))
+    with db.batch():
+        for n in range(50):
+            db.set('O%d' % n, 'n', n)
+            db.set('O%d' % n, 's', 'value-%d' % n)
+    db.link('O1', 'prev', 'O0')
+    buf = io.BytesIO()
+    db.snapshot(buf)
+
+    other = AboutDB()
+    other.index(None, 'n', field_type=int)
+    other.define('by_n', lambda o: (o['n'], None))
+    buf.seek(0)
+    other.load_snapshot(buf)
+    assert other.get('O1') == db.get('O1')
+    assert list(other.lookup(None, 'n', 7)) == ['O7']
+    assert [row['id'] for row in other.view('by_n', limit=2)] == ['O0', 'O1']
+
+
+def by_n(doc):
+    return doc['n'], 1
+
+
+def count(keys, values, rereduce):
+    return sum(values)
+
+
+@pytest.fixture(scope='function')
+def sharded():
+    db = ShardedAboutDB(shards=3)
+    yield db
+    db.close()
+
+
+def test_sharded_routing_and_links(sharded: ShardedAboutDB):
+    ids = ['O%d' % n for n in range(20)]
+    assert len({sharded.shard_of(identity) for identity in ids}) == 3
+    with sharded.batch():
+        for n, identity in enumerate(ids):
+            sharded.set(identity, 'n', n)
+    for identity, target in zip(ids, ids[1:] + ids[:1]):
+        sharded.link(identity, 'next', target)
+    obj = sharded.get('O0', depth=2)
+    assert obj['next']['next'] == {'n': 2, 'next': {'_id': 'O3'}, '_id': 'O2'}
+    assert sharded.get('O0', fields=['n']) == {'n': 0, '_id': 'O0'}
+    assert [o['n'] for o in sharded.get_many(['O5', 'O6'], depth=0)] == [5, 6]
+    sharded.delete('O3')
+    with pytest.raises(KeyError):
+        sharded.get('O3')
+
+
+def test_sharded_lookup_and_views(sharded: ShardedAboutDB):
+    sharded.index(None, 'n', field_type=int)
+    sharded.define('by_n', by_n, count)
+    sharded.set_many(('O%d' % n, 'n', n % 5) for n in range(30))
+    assert sorted(sharded.lookup(None, 'n', 3)) == sorted('O%d' % n for n in range(3, 30, 5))
+    assert list(sharded.query(None, where={'n': 3}, limit=2)) == ['O13', 'O18']
+    assert sharded.aggregate(None, 'n') == {'count': 30, 'sum': 60, 'min': 0, 'max': 4}
+    assert sorted(sharded.column(None, 'n')) == sorted(n % 5 for n in range(30))
+    assert [v for v, _ in sharded.lookup_range(None, 'n', startkey=1, limit=8)] == [1] * 6 + [2] * 2
+    assert list(sharded.view('by_n')) == [{'key': None, 'value': 30}]
+    assert [row['value'] for row in sharded.view('by_n', group=True)] == [6] * 5
+    rows = list(sharded.view('by_n', reduce=False, skip=5, limit=3, include_docs=True))
+    assert [row['key'] for row in rows] == [0, 1, 1]
+    assert rows[0]['doc']['n'] == 0
+
+
+def test_column_and_aggregates(db: AboutDB):
+    db.track('Row', 'n')
+    with db.batch():
+        for n in range(10):
+            db.set('R%d' % n, '*schema', 'Row')
+            db.set('R%d' % n, 'n', n)
+            db.set('R%d' % n, 'x', n / 2)
+        db.set('Other', 'n', 100)
+        db.set('Text', 'n', 'not a number')
+    assert list(db.column('Row', 'n')) == list(range(10))
+    assert db.column('Row', 'n').typecode == 'q'
+    assert db.column(None, 'x').typecode == 'd'
+    ids, values = db.column(None, 'n', with_ids=True)
+    assert ids[-1] == 'Other' and values[-1] == 100
+    assert db.aggregate('Row', 'n') == {'count': 10, 'sum': 45, 'min': 0, 'max': 9}
+    db.set('R3', 'n', 30)
+    db.delete('R0')
+    assert db._aggregates[('Row', 'n')].stale
+    assert db.aggregate('Row', 'n') == {'count': 9, 'sum': 72, 'min': 1, 'max': 30}
+    db.unset('R5', 'n')
+    assert db.aggregate('Row', 'n') == {'count': 8, 'sum': 67, 'min': 1, 'max': 30}
+    counts, edges = db.histogram('Row', 'n', bins=3, bounds=(0, 30))
+    assert counts == [7, 0, 1] and edges == [0, 10, 20, 30]
+
+
+def test_tracked_aggregate_stays_fresh_on_inserts_and_schema_moves(db: AboutDB):
+    db.track('Row', 'n')
+    db.track('Old', 'n')
+    assert db.aggregate('Row', 'n')['count'] == db.aggregate('Old', 'n')['count'] == 0
+    with db.batch():
+        for n in range(1, 6):
+            db.set('R%d' % n, '*schema', 'Row')
+            db.set('R%d' % n, 'n', n)
+    db.set('R9', 'n', 9)
+    db.set('R9', '*schema', 'Row')
+    db.set('R2', '*schema', 'Old')
+    assert not db._aggregates[('Row', 'n')].stale and not db._aggregates[('Old', 'n')].stale
+    assert db.aggregate('Row', 'n') == {'count': 5, 'sum': 22, 'min': 1, 'max': 9}
+    assert db.aggregate('Old', 'n') == {'count': 1, 'sum': 2, 'min': 2, 'max': 2}
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_scan_with_cursor(compact):
+    db = AboutDB(compact_register=compact)
+    with db.batch():
+        for n in range(25):
+            db.set('O%02d' % n, '*schema', 'Even' if n % 2 == 0 else 'Odd')
+            db.set('O%02d' % n, 'n', n)
+    db.link('O01', 'other', 'O00')
+    db.delete('O03')
+    assert [o['_id'] for o in db.scan(batch_size=4)][:4] == ['O00', 'O01', 'O02', 'O04']
+    assert next(iter(db.scan(schema='Odd')))['other'] == {'_id': 'O00'}
+
+    scan = db.scan(schema='Even', fields=['n'], batch_size=3)
+    page = [row for _, row in zip(range(5), scan)]
+    assert page == [('O%02d' % n, n) for n in range(0, 10, 2)]
+    db.set('O10', 'n', -1)
+    db.set('O99', '*schema', 'Even')
+    rest = list(db.scan(schema='Even', fields=['n', 'missing'], after=scan.cursor))
+    assert rest[0] == ('O10', -1, None)
+    assert [row[0] for row in rest][-2:] == ['O24', 'O99']
+    with pytest.raises(ValueError):
+        db.scan(after='not a cursor')
+
+
+def test_sharded_unpicklable_value_keeps_pipes_in_sync(sharded: ShardedAboutDB):
+    sharded.set('A', 'a', 1)
+    with pytest.raises((pickle.PicklingError, AttributeError)):
+        sharded.set_many([('A', 'a', 2), ('B', 'b', lambda: None)] + [('O%d' % n, 'n', n) for n in range(10)])
+    assert sharded.get('A')['a'] == 1
+
+
+def test_sharded_threads_use_separate_pipes(sharded: ShardedAboutDB):
+    def worker(n):
+        for m in range(50):
+            sharded.set('T%d-%d' % (n, m), 'n', m)
+            assert sharded.get('T%d-%d' % (n, m))['n'] == m
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sharded.aggregate(None, 'n')['count'] == 200
+
+
+def test_scan_cursor_survives_reopen_and_snapshot(tmp_path):
+    path = str(tmp_path / 'store')
+    with AboutDB(path=path) as db:
+        for n in range(10):
+            db.set('O%d' % n, 'n', n)
+        db.delete('O2')
+        scan = db.scan(fields=['n'])
+        assert [row[0] for _, row in zip(range(4), scan)] == ['O0', 'O1', 'O3', 'O4']
+        cursor = scan.cursor
+        list(scan)
+        end = scan.cursor
+        db.delete('O9')
+        buf = io.BytesIO()
+        db.snapshot(buf)
+    with AboutDB(path=path) as db:
+        db.set('O0', 'n', -1)
+        db.set('N', 'n', 10)
+        assert [row[0] for row in db.scan(fields=['n'], after=cursor)] == ['O5', 'O6', 'O7', 'O8', 'N']
+        assert [row[0] for row in db.scan(fields=['n'], after=end)] == ['N']
+    other = AboutDB()
+    buf.seek(0)
+    other.load_snapshot(buf)
+    assert [row[0] for row in other.scan(fields=['n'], after=cursor)] == ['O5', 'O6', 'O7', 'O8']
+
+
+def test_get_many_results_do_not_share_targets():
+    db = AboutDB()
+    db.set('T', 'tags', ['a'])
+    db.link('A', 'to', 'T')
+    db.link('B', 'to', 'T')
+    a, b = db.get_many(['A', 'B'])
+    a['to']['tags'].append('b')
+    a['to']['name'] = 'changed'
+    assert b['to'] == {'_id': 'T', 'tags': ['a']}
+
+
+def test_get_many_expands_links_like_get():
+    db = AboutDB()
+    db.set('A', 'a', 1)
+    db.link('A', 'b', 'B')
+    db.link('B', 'a', 'A')
+    db.link('B', 'c', 'C')
+    db.set('C', 'n', [1])
+    for depth in (None, 0, 1, 2):
+        assert db.get_many(['A', 'B', 'A'], depth=depth) == [db.get(x, depth=depth) for x in 'ABA']
+    assert db.get_many(['A'])[0]['b']['a'] == {'_id': 'A'}
+    assert db.get_many(['A'], fields=['b'])[0] == db.get('A', fields=['b'])
+
+
+def test_get_shared_target_values_are_independent(db: AboutDB):
+    db.set('T', 'l', [1])
+    db.set('T', 'd', {'k': [2]})
+    db.link('A', 'p', 'T')
+    db.link('A', 'q', 'T')
+    r = db.get('A')
+    r['p']['l'].append(9)
+    r['p']['d']['k'].append(9)
+    assert r['q'] == {'_id': 'T', 'l': [1], 'd': {'k': [2]}}
@@ -7,7 +7,6 @@ from pprint import pprint as pp
 from .fixtures import *
 
 
-@pytest.mark.skip
 def test_view_just_save(db):
     db.index('Entry', 'a')
     db.set('A', '*schema', 'Entry')
@@ -21,7 +20,6 @@ def test_view_just_save(db):
     assert list(db.lookup('Entry', 'a', 3)) == ['B']
 
 
-@pytest.mark.skip
 def test_view_save_and_update_value(db):
     db.index('Entry', 'a')
     db.set('A', '*schema', 'Entry')
@@ -31,12 +29,8 @@ def test_view_save_and_update_value(db):
     db.set('B', 'a', 3)
     db.set('B', 'b', 4)
 
-    pp(db._data)
-
     db.set('B', 'a', 1)
 
-    pp(db._data)
-
     assert list(db.lookup('Entry', 'a', 1)) == ['A', 'B']
     assert list(db.lookup('Entry', 'a', 3)) == []
 
@@ -299,3 +293,372 @@ def test_skip_and_limit(db):
                     'doc': {ID: 2, '_rev': 0, '2': 12}}
     assert r[1] == {'id': 5, 'key': 5, 'value': 1,
                     'doc': {ID: 5, '_rev': 0, '5': 15}}
+
+
+def test_batch_indexes_in_one_pass(db):
+    db.index('Entry', 'a')
+    with db.batch():
+        for n in range(10):
+            db.set('O%d' % n, '*schema', 'Entry')
+            db.set('O%d' % n, 'a', n)
+    rows = db._index_db_conn.execute('SELECT OBJECT_ID, VALUE FROM ENTRY_A ORDER BY ID').fetchall()
+    assert rows == [('O%d' % n, str(n)) for n in range(10)]
+
+
+def test_lookup(db):
+    db.index('Entry', 'a')
+    db.set('A', '*schema', 'Entry')
+    db.set('A', 'a', 'x')
+    db.set('B', '*schema', 'Entry')
+    db.set('B', 'a', 'y')
+    assert list(db.lookup('Entry', 'a', 'x')) == ['A']
+    assert list(db.lookup('Entry', 'a', 'z')) == []
+
+
+def test_lookup_uses_sql_index(db):
+    db.index('Entry', 'a')
+    plan = db._index_db_conn.execute(
+        "EXPLAIN QUERY PLAN SELECT OBJECT_ID FROM ENTRY_A WHERE VALUE = ?", ('x',)).fetchall()
+    assert 'ENTRY_A_VALUE' in str(plan)
+
+
+@pytest.fixture(scope='function')
+def ranged(db):
+    db.index('Entry', 'n', field_type=int)
+    with db.batch():
+        for n in (5, 1, 4, 2, 3):
+            db.set('O%d' % n, '*schema', 'Entry')
+            db.set('O%d' % n, 'n', n)
+    return db
+
+
+def test_lookup_range(ranged):
+    assert list(ranged.lookup_range('Entry', 'n')) == [(n, 'O%d' % n) for n in range(1, 6)]
+    assert list(ranged.lookup_range('Entry', 'n', startkey=2, endkey=4)) == [(2, 'O2'), (3, 'O3'), (4, 'O4')]
+    assert list(ranged.lookup_range('Entry', 'n', startkey=3, limit=1)) == [(3, 'O3')]
+
+
+def test_lookup_range_descending(ranged):
+    r = list(ranged.lookup_range('Entry', 'n', startkey=4, endkey=2, descending=True))
+    assert r == [(4, 'O4'), (3, 'O3'), (2, 'O2')]
+
+
+def test_index_dispatch_by_schema_and_field(db):
+    for n in range(20):
+        db.index('Entry', 'f%d' % n)
+    db.index('Other', 'f0')
+    db.index(None, 'tag')
+    db.set('A', '*schema', 'Entry')
+    db.set('A', 'f0', 'x')
+    db.set('A', 'tag', 't')
+    assert db._indexes_for('Entry', 'f0') == db._index_by_key[('Entry', 'f0')]
+    assert list(db.lookup('Entry', 'f0', 'x')) == ['A']
+    assert list(db.lookup('Other', 'f0', 'x')) == []
+    assert list(db.lookup(None, 'tag', 't')) == ['A']
+    assert list(db.lookup(None, '*schema', 'Entry')) == ['A']
+
+
+def test_index_unset_and_delete(db):
+    db.index('Entry', 'a')
+    db.set('A', '*schema', 'Entry')
+    db.set('A', 'a', 1)
+    db.set('B', '*schema', 'Entry')
+    db.set('B', 'a', 1)
+    db.unset('A', 'a')
+    assert list(db.lookup('Entry', 'a', 1)) == ['B']
+    db.delete('B')
+    assert list(db.lookup('Entry', 'a', 1)) == []
+    assert list(db.lookup(None, '*schema', 'Entry')) == ['A']
+
+
+def test_unset_schema_keeps_schemaless_indexes(db):
+    db.index(None, 'tag')
+    db.index('Entry', 'tag')
+    db.set('A', '*schema', 'Entry')
+    db.set('A', 'tag', 't')
+    db.unset('A', '*schema')
+    assert list(db.lookup(None, 'tag', 't')) == ['A']
+    assert list(db.lookup('Entry', 'tag', 't')) == []
+    assert list(db.lookup(None, '*schema', 'Entry')) == []
+
+
+def test_index_schema_change(db):
+    db.index('Entry', 'a')
+    db.index('Other', 'a')
+    db.set('A', 'a', 1)
+    db.set('A', '*schema', 'Entry')
+    assert list(db.lookup('Entry', 'a', 1)) == ['A']
+    db.set('A', '*schema', 'Other')
+    assert list(db.lookup('Entry', 'a', 1)) == []
+    assert list(db.lookup('Other', 'a', 1)) == ['A']
+
+
+def test_index_backfill(db):
+    db.set('A', '*schema', 'Entry')
+    db.set('A', 'a', 1)
+    db.set('B', '*schema', 'Other')
+    db.set('B', 'a', 1)
+    db.index('Entry', 'a')
+    assert list(db.lookup('Entry', 'a', 1)) == ['A']
+
+
+@pytest.fixture(scope='function')
+def entries(db):
+    with db.batch():
+        for identity, a, b in (('O0', 2, 22), ('O1', 3, 33), ('O2', 1, 11)):
+            db.set(identity, 'a', a)
+            db.set(identity, 'b', b)
+    return db
+
+
+def test_define_and_view(entries):
+    entries.define('b_by_a', lambda o: (o['a'], o['b']))
+    r = list(entries.view('b_by_a'))
+    assert r == [{'id': 'O2', 'key': 1, 'value': 11},
+                 {'id': 'O0', 'key': 2, 'value': 22},
+                 {'id': 'O1', 'key': 3, 'value': 33}]
+
+
+def test_view_ranges(entries):
+    entries.define('b_by_a', lambda o: (o['a'], o['b']))
+    assert [r['key'] for r in entries.view('b_by_a', key=2)] == [2]
+    assert [r['key'] for r in entries.view('b_by_a', startkey=2)] == [2, 3]
+    assert [r['key'] for r in entries.view('b_by_a', endkey=2)] == [1, 2]
+    assert [r['key'] for r in entries.view('b_by_a', skip=1, limit=1)] == [2]
+    assert [r['key'] for r in entries.view('b_by_a', descending=True)] == [3, 2, 1]
+
+
+def test_view_updated_on_write(entries):
+    entries.define('b_by_a', lambda o: (o['a'], o['b']))
+    entries.set('O3', 'a', 0)
+    entries.set('O3', 'b', 0)
+    entries.set('O0', 'a', 5)
+    entries.delete('O1')
+    r = [(row['id'], row['key']) for row in entries.view('b_by_a')]
+    assert r == [('O3', 0), ('O2', 1), ('O0', 5)]
+
+
+def test_view_yielding_map_and_include_docs(entries):
+    def yielder(o):
+        yield (o['a'], 1), o['b']
+        yield (o['a'], 2), o['b'] * 2
+
+    entries.define('multi', yielder)
+    r = list(entries.view('multi', startkey=(2, 2), include_docs=True))
+    assert [row['key'] for row in r] == [(2, 2), (3, 1), (3, 2)]
+    assert r[0]['doc']['b'] == 22
+
+
+def test_view_reduce_by_group(db):
+    def count(keys, values, rereduce):
+        return len(values)
+
+    db.define('by_category', lambda o: (o['category'], 1), count)
+    for n, category in enumerate('abacab'):
+        db.set('O%d' % n, 'category', category)
+    assert list(db.view('by_category', group=True)) == [
+        {'key': 'a', 'value': 3}, {'key': 'b', 'value': 2}, {'key': 'c', 'value': 1}]
+    assert list(db.view('by_category')) == [{'key': None, 'value': 6}]
+    db.set('O0', 'category', 'c')
+    assert list(db.view('by_category', group=True)) == [
+        {'key': 'a', 'value': 2}, {'key': 'b', 'value': 2}, {'key': 'c', 'value': 2}]
+
+
+def test_view_maps_unexpanded_documents(db):
+    db.set('P', 'name', 'p')
+    db.set('A', 'n', 1)
+    db.link('A', 'parent', 'P')
+    db.define('by_parent', lambda o: (o['parent']['_id'], o['parent'].get('name')))
+    assert list(db.view('by_parent')) == [{'id': 'A', 'key': 'P', 'value': None}]
+    db.set('P', 'name', 'q')
+    assert list(db.view('by_parent', include_docs=True))[0]['doc']['parent']['name'] == 'q'
+
+
+def test_view_skips_failing_map(entries, caplog):
+    entries.define('ratio', lambda o: (o['b'] // (o['a'] - 1), o['a']))
+    assert [row['id'] for row in entries.view('ratio')] == ['O1', 'O0']
+    entries.define('by_b', lambda o: (o['b'], 1))
+    entries.set('O0', 'a', 1)
+    entries.set('O1', 'b', {'unsupported': 'key'})
+    assert [row['id'] for row in entries.view('ratio')] == []
+    assert [row['id'] for row in entries.view('by_b')] == ['O2', 'O0']
+    assert entries.get('O0')['a'] == 1
+    assert entries.get('O1')['b'] == {'unsupported': 'key'}
+    assert 'View ratio skipped O0' in caplog.text
+    assert 'View by_b skipped O1' in caplog.text
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'memory'])
+def test_index_backends(db, backend):
+    db.set('Z', '*schema', 'Entry')
+    db.set('Z', 'n', 3)
+    db.index('Entry', 'n', field_type=int, backend=backend)
+    with db.batch():
+        for n in (5, 1, 4, 2, 3):
+            db.set('O%d' % n, '*schema', 'Entry')
+            db.set('O%d' % n, 'n', n)
+    assert list(db.lookup('Entry', 'n', 3)) == ['O3', 'Z']
+    assert list(db.lookup_range('Entry', 'n', startkey=2, endkey=3)) == [(2, 'O2'), (3, 'O3'), (3, 'Z')]
+    assert list(db.lookup_range('Entry', 'n', startkey=4, endkey=3, descending=True, limit=2)) == \
+        [(4, 'O4'), (3, 'Z')]
+    db.set('O3', 'n', 6)
+    db.delete('Z')
+    assert list(db.lookup('Entry', 'n', 3)) == []
+    assert list(db.lookup_range('Entry', 'n', startkey=5)) == [(5, 'O5'), (6, 'O3')]
+
+
+def test_unconvertible_value_rejected_without_side_effects(tmp_path):
+    path = str(tmp_path / 'store')
+    with AboutDB(path=path) as db:
+        db.index('Entry', 'n', field_type=int)
+        db.set('A', '*schema', 'Entry')
+        db.set('A', 'n', 5)
+        with pytest.raises(ValueError):
+            db.set('A', 'n', 'abc')
+        with pytest.raises(ValueError):
+            with db.batch():
+                db.set('B', 'n', 'abc')
+                db.set('B', '*schema', 'Entry')
+        assert db.get('A') == {ID: 'A', '*schema': 'Entry', 'n': 5}
+        with pytest.raises(KeyError):
+            db.get('B')
+        assert list(db.lookup('Entry', 'n', 5)) == ['A']
+    with AboutDB(path=path) as db:
+        db.index('Entry', 'n', field_type=int)
+        assert db.get('A')['n'] == 5
+        assert list(db.lookup('Entry', 'n', 5)) == ['A']
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'memory'])
+def test_backends_agree_after_failed_writes(db, backend):
+    broken = []
+
+    def length(value):
+        if broken:
+            raise ValueError(value)
+        return len(value)
+
+    db.index('Entry', 'n', field_type=int, backend=backend)
+    db.index('Entry', 'w', fn=length, field_type=int, backend=backend)
+    db.set('A', '*schema', 'Entry')
+    db.set('A', 'n', 5)
+    db.set('A', 'w', 'abc')
+    with pytest.raises(ValueError):
+        db.set('A', 'n', 'abc')
+    with pytest.raises(ValueError):
+        with db.deferred_indexing():
+            db.set('A', 'w', 'ab')
+            broken.append(True)
+    assert list(db.lookup('Entry', 'n', 5)) == ['A']
+    assert list(db.lookup('Entry', 'w', 3)) == ['A']
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'memory'])
+def test_failed_backfill_does_not_register_index(db, backend):
+    db.set('A', '*schema', 'Entry')
+    db.set('A', 'n', 'abc')
+    with pytest.raises(ValueError):
+        db.index('Entry', 'n', field_type=int, backend=backend)
+    db.set('A', 'n', 'def')
+    assert db.lookup('Entry', 'n', 1) is None
+    db.set('A', 'n', 7)
+    db.index('Entry', 'n', field_type=int, backend=backend)
+    assert list(db.lookup('Entry', 'n', 7)) == ['A']
+
+
+def test_index_table_name_collision(db):
+    db.index(None, 'a1')
+    db.index(None, 'a2')
+    with pytest.raises(ValueError):
+        db.index(None, 'a-1')
+    db.index('Entry', 't', kind='token')
+    with pytest.raises(ValueError):
+        db.index('Entry', 'T', field='t', kind='trigram')
+    with pytest.raises(ValueError):
+        db.index(None, 'schema')
+    db.set('A', 'a1', 'x')
+    db.set('B', 'a2', 'x')
+    db.set('A', 'a-1', 'y')
+    assert list(db.lookup(None, 'a1', 'x')) == ['A']
+    assert list(db.lookup(None, 'a2', 'x')) == ['B']
+    assert db.lookup(None, 'a-1', 'y') is None
+
+
+def test_memory_index_unknown_backend(db):
+    with pytest.raises(ValueError):
+        db.index('Entry', 'n', backend='btree')
+
+
+@pytest.fixture(scope='function', params=['sqlite', 'memory'])
+def people(db, request):
+    db.index('Person', 'age', field_type=int, backend=request.param)
+    db.index('Person', 'city', backend=request.param)
+    with db.batch():
+        for n in range(200):
+            db.set('P%03d' % n, '*schema', 'Person')
+            db.set('P%03d' % n, 'age', n % 50)
+            db.set('P%03d' % n, 'city', 'Lund' if n % 20 == 0 else 'Malmo')
+            db.set('P%03d' % n, 'score', n)
+        db.set('X', 'age', 0)
+    return db
+
+
+def test_query_and(people):
+    r = list(people.query('Person', where={'city': 'Lund', 'age': {'$gte': 10, '$lt': 30}}))
+    assert r == ['P020', 'P060', 'P120', 'P160']
+    assert list(people.query('Person', where={'age': 0})) == ['P000', 'P050', 'P100', 'P150']
+    assert list(people.query('Person', where={'age': {'$in': [1, 2]}}, limit=3)) == ['P001', 'P002', 'P051']
+
+
+def test_query_or_and_residual(people):
+    r = list(people.query('Person', where={'score': {'$gt': 100},
+                                           '$or': [{'age': 1}, {'city': 'Lund'}]}))
+    assert r == ['P101', 'P120', 'P140', 'P151', 'P160', 'P180']
+    assert list(people.query(None, where={'score': {'$lte': 1}})) == ['P000', 'P001']
+    r = list(people.query('Person', where={'age': {'$gte': 10}, '$or': [{'age': 1}, {'age': 15}]}))
+    assert r == ['P015', 'P065', 'P115', 'P165']
+
+
+def test_query_plan_starts_from_most_selective(people):
+    plan, = people.explain('Person', where={'city': 'Lund', 'age': 3, 'score': 5})
+    assert [(step, field) for step, field, _ in plan] == \
+        [('scan', 'age'), ('merge', 'city'), ('probe', '*schema'), ('residual', 'score')]
+    people.set('P003', 'age', 4)
+    assert list(people.query('Person', where={'age': 3})) == ['P053', 'P103', 'P153']
+
+
+@pytest.fixture(scope='function')
+def docs(db):
+    db.index('Doc', 'body_terms', field='body', kind='token')
+    db.index('Doc', 'title_prefix', field='title', kind='prefix')
+    db.index('Doc', 'title_grams', field='title', kind='trigram')
+    for identity, title, body in (('D1', 'Quick Brown Fox', 'the fox jumps over the lazy dog'),
+                                  ('D2', 'Lazy Afternoon', 'a lazy lazy dog sleeps'),
+                                  ('D3', 'Brownies', 'chocolate brownies and a fox')):
+        db.set(identity, '*schema', 'Doc')
+        db.set(identity, 'title', title)
+        db.set(identity, 'body', body)
+    return db
+
+
+def test_token_search_ranked(docs):
+    assert list(docs.search('Doc', 'body', 'lazy dog')) == ['D2', 'D1']
+    assert list(docs.search('Doc', 'body', 'fox dog', match='all')) == ['D1']
+    assert list(docs.search('Doc', 'body', 'fox', limit=1)) == ['D1']
+    docs.set('D1', 'body', 'nothing here')
+    assert list(docs.search('Doc', 'body', 'fox')) == ['D3']
+
+
+def test_prefix_search(docs):
+    assert list(docs.search('Doc', 'title', 'bro', kind='prefix')) == ['D1', 'D3']
+    assert list(docs.search('Doc', 'title', 'La', kind='prefix')) == ['D2']
+    docs.delete('D2')
+    assert list(docs.search('Doc', 'title', 'la', kind='prefix')) == []
+
+
+def test_trigram_search(docs):
+    assert list(docs.search('Doc', 'title', 'rown', kind='trigram')) == ['D1', 'D3']
+    assert list(docs.search('Doc', 'title', 'k b', kind='trigram')) == ['D1']
+    assert list(docs.search('Doc', 'title', 'ft', kind='trigram')) == ['D2']
+    assert list(docs.search('Doc', 'title', 'wnx', kind='trigram')) == []
+    assert docs.lookup('Doc', 'title', 'Brownies') is None